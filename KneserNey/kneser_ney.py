@@ -6,23 +6,428 @@
 # @author David Rubin
 # @license MIT (check repository)
 # FERI, Language technoligies, 2019
+import os
+import sys
 import json
 import glob
+import multiprocessing
+import mmap
+import bisect
+import struct
 import string
 import nltk
 import math
 import numpy
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, Counter
+from functools import lru_cache
+from pathlib import Path
 from timeit import default_timer as timer
+try:
+    from instrument import stats
+except ImportError:
+    # Skupna instrumentacija je v korenu repozitorija (../instrument.py)
+    sys.path.append(str(Path(__file__).resolve().parents[1]))
+    from instrument import stats
+
+# Oznaka na zacetku binarne datoteke z modelom
+MODEL_MAGIC = b'LTNGRAM1'
+# Logaritem verjetnosti <s> v formatu ARPA (zacetka povedi ne napovedujemo)
+ARPA_START_LOG_PROB = -99.0
+# Logaritem verjetnosti <unk>, ce ga ARPA model nima (npr. SRILM brez -unk), enako kot v KenLM
+ARPA_UNK_LOG_PROB = -100.0
+# Locila, ki jih odstranimo iz povedi
+REMOVE_PUNCTUATION = str.maketrans("", "", string.punctuation + '»«−…•')
+
+
+@lru_cache(maxsize=None)
+def slovene_tokenizer():
+    """ Nalozi punkt tokenizator za slovenscino (le enkrat na proces) """
+    return nltk.data.load('tokenizers/punkt/slovene.pickle')
+
+
+def key_dtype(bits, width):
+    """
+    Vrne tip kljucev k-gramov z width besedami po bits bitov. Ce id-ji ne gredo v en uint64, je kljuc zapis
+    vec uint64 besed (vsaka hrani 64 // bits id-jev, prva najbolj levo), ki se primerja leksikografsko.
+    """
+    words = -(-width // (64 // bits))
+    if words <= 1:
+        return numpy.dtype(numpy.uint64)
+    return numpy.dtype([('w%d' % i, numpy.uint64) for i in range(words)])
+
+
+def pack_kgrams(ids, bits):
+    """ Zapakira matriko id-jev (vsaka vrstica je en k-gram) v en kljuc na k-gram (glej key_dtype) """
+    dtype = key_dtype(bits, ids.shape[1])
+    if dtype.names is not None:
+        per_word = 64 // bits
+        keys = numpy.zeros(len(ids), dtype=dtype)
+        for i, name in enumerate(dtype.names):
+            keys[name] = pack_kgrams(ids[:, i * per_word:(i + 1) * per_word], bits)
+        return keys
+    keys = numpy.zeros(len(ids), dtype=numpy.uint64)
+    for column in range(ids.shape[1]):
+        keys = (keys << numpy.uint64(bits)) | ids[:, column].astype(numpy.uint64)
+    return keys
+
+
+def unpack_kgrams(keys, bits, width):
+    """ Obratno kot pack_kgrams: iz kljucev k-gramov z width besedami vrne matriko id-jev (uint64) """
+    dtype = key_dtype(bits, width)
+    if dtype.names is not None:
+        per_word = 64 // bits
+        return numpy.hstack([unpack_kgrams(keys[name], bits, min(per_word, width - i * per_word))
+                             for i, name in enumerate(dtype.names)])
+    ids = numpy.zeros((len(keys), width), dtype=numpy.uint64)
+    mask = numpy.uint64((1 << bits) - 1)
+    for column in range(width - 1, -1, -1):
+        ids[:, column] = keys & mask
+        keys = keys >> numpy.uint64(bits)
+    return ids
+
+
+def sum_counts(keys, values):
+    """ Uredi kljuce in sesteje vrednosti enakih kljucev, vrne urejene unikatne kljuce in vsote """
+    if len(keys) == 0:
+        return keys, values
+    # Zapise (glej key_dtype) uredimo po poljih, kar je veliko hitreje od primerjanja celih zapisov
+    fields = [keys[name] for name in keys.dtype.names] if keys.dtype.names else [keys]
+    order = numpy.lexsort(fields[::-1])
+    fields = [x[order] for x in fields]
+    different = numpy.zeros(len(keys) - 1, dtype=bool)
+    for x in fields:
+        different |= x[1:] != x[:-1]
+    starts = numpy.flatnonzero(numpy.concatenate([[True], different]))
+    return keys[order[starts]], numpy.add.reduceat(values[order], starts)
+
+
+def lookup_counts(table, keys, default=0):
+    """ Vektorsko poisce zapakirane kljuce v tabeli MappedCounts, manjkajoci imajo vrednost default """
+    if len(table.packed) == 0:
+        return numpy.full(len(keys), default)
+    i = numpy.searchsorted(table.packed, keys)
+    i[i == len(table.packed)] = 0
+    return numpy.where(table.packed[i] == keys, table.value_array(i), default)
+
+
+def quantize(values, bits):
+    """
+    Kvantizira tabelo vrednosti na najvec 2^bits nivojev in vrne kode (uint8 ali uint16) ter kodirno knjigo
+    (vrednost = knjiga[koda]). Ce je razlicnih vrednosti dovolj malo, je kvantizacija brez izgub.
+    Sicer pri celih stevilih (stetjih) polovico nivojev porabi za najmanjse vrednosti, ki jih ohrani tocno,
+    ostale vrednosti pa razdeli v razrede s priblizno enakim stevilom pojavitev. Razred predstavlja
+    tehtano povprecje (pri stetjih geometrijsko in zaokrozeno).
+    """
+    if bits not in (8, 16):
+        raise ValueError('Podprta je le 8 ali 16 bitna kvantizacija')
+    levels = 1 << bits
+    code_type = numpy.uint8 if bits == 8 else numpy.uint16
+    unique, inverse, occurrences = numpy.unique(values, return_inverse=True, return_counts=True)
+    if len(unique) <= levels:
+        return inverse.astype(code_type), unique
+    integer = numpy.issubdtype(unique.dtype, numpy.integer)
+    exact = levels // 2 if integer else 0
+    # Preostale vrednosti razdelimo v razrede glede na kumulativno stevilo pojavitev
+    rest = occurrences[exact:]
+    before = numpy.cumsum(rest) - rest
+    groups = exact + (before * (levels - exact) // rest.sum())
+    codes = numpy.concatenate([numpy.arange(exact), groups]).astype(numpy.int64)
+    # Kode naj bodo zaporedne (nekateri razredi so lahko prazni)
+    used, codes = numpy.unique(codes, return_inverse=True)
+    domain = numpy.log(unique.astype(numpy.float64)) if integer else unique.astype(numpy.float64)
+    codebook = numpy.bincount(codes, weights=domain * occurrences) / numpy.bincount(codes, weights=occurrences)
+    if integer:
+        codebook = numpy.rint(numpy.exp(codebook)).astype(unique.dtype)
+    return codes[inverse].astype(code_type), codebook
+
+
+def vocabulary_arrays(words):
+    """ Zapise besede kot UTF-8 bajte in odmike (beseda i je med odmikoma i in i+1) """
+    encoded = [word.encode('utf-8') for word in words]
+    data = numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8)
+    offsets = numpy.cumsum([0] + [len(word) for word in encoded], dtype=numpy.uint64)
+    return data, offsets
+
+
+def write_arrays(filename, header, arrays):
+    """
+    Zapise tabele v binarno datoteko: oznaka, odmik in dolzina glave, tabele poravnane na 8 bajtov
+    in na koncu JSON glava z opisom tabel (tip, dolzina, odmik v datoteki).
+    """
+    header = dict(header, arrays={})
+    with open(filename, 'wb') as f:
+        f.write(MODEL_MAGIC + bytes(16))
+        for name, array in arrays.items():
+            # Tabele poravnamo na 8 bajtov, da jih lahko neposredno preslikamo
+            f.write(bytes(-f.tell() % 8))
+            # Zapisi (kljuci iz vec uint64 besed, glej key_dtype) shranimo z imeni polj
+            dtype = array.dtype.descr if array.dtype.names else array.dtype.str
+            header['arrays'][name] = [dtype, len(array), f.tell()]
+            f.write(numpy.ascontiguousarray(array).tobytes())
+        header_offset = f.tell()
+        header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        f.write(header_bytes)
+        f.seek(len(MODEL_MAGIC))
+        f.write(struct.pack('<QQ', header_offset, len(header_bytes)))
+
+
+def map_arrays(filename):
+    """ Preslika datoteko, ki jo je zapisal write_arrays, in vrne (mmap, glava, tabele) """
+    with open(filename, 'rb') as f:
+        model_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header_offset, header_len = struct.unpack_from('<QQ', model_map, len(MODEL_MAGIC))
+    header = json.loads(model_map[header_offset:header_offset + header_len].decode('utf-8'))
+    arrays = {name: numpy.frombuffer(model_map, count=length, offset=offset,
+                                     dtype=[tuple(x) for x in dtype] if isinstance(dtype, list) else dtype)
+              for name, (dtype, length, offset) in header['arrays'].items()}
+    return model_map, header, arrays
+
+
+def decode_key(key):
+    """ Pretvori kljuc iz JSON modela nazaj v k-gram (UNK se je shranil kot 'U N K') """
+    return 'UNK' if key == 'U N K' else tuple(key.split())
+
+
+def count_shard(job):
+    """
+    Presteje n-grame ene datoteke v locenem procesu (glej LanguageModel.train)
+
+    :param job: par (ime datoteke, velikost n-gramov)
+    :return: besede lokalnega besednjaka in stetja k-gramov z lokalnimi id-ji
+    """
+    filename, n = job
+    model = LanguageModel(n)
+    vocabulary = Vocabulary()
+    counts = model.new_counts()
+    model.count_file(filename, counts, vocabulary)
+    return vocabulary.words, counts
+
+
+class Vocabulary:
+    """ Preslikava besed v zaporedne id-je, vsako besedo hranimo le enkrat """
+
+    def __init__(self):
+        self.ids = {}
+        self.words = []
+
+    def intern(self, word):
+        """ Vrne id besede, nove besede doda na konec """
+        i = self.ids.get(word)
+        if i is None:
+            i = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return i
+
+    def bits(self):
+        """ Vrne stevilo bitov, ki jih potrebuje id besede (glej pack_kgrams) """
+        return max(1, len(self.words).bit_length())
+
+
+class KGramCounts:
+    """
+    Surova stetja k-gramov ene stopnje med ucenjem: urejeni zapakirani kljuci (glej pack_kgrams) in stevila
+    pojavitev. Id-ji imajo toliko bitov, kot jih potrebuje besednjak (glej widen). Stetja paketov dodajamo
+    sproti, z ze urejenimi stetji pa jih zdruzimo sele, ko jih je vec kot teh (glej merge).
+    """
+
+    def __init__(self, width, bits=1):
+        self.width = width
+        self.bits = bits
+        self.keys = numpy.zeros(0, dtype=key_dtype(bits, width))
+        self.values = numpy.zeros(0, dtype=numpy.int64)
+        self.pending = []
+
+    def widen(self, bits):
+        """ Ponovno zapakira kljuce z bits biti na id, ko se besednjak poveca (vrstni red kljucev ostane) """
+        if bits <= self.bits:
+            return
+        self.merge()
+        self.keys = pack_kgrams(unpack_kgrams(self.keys, self.bits, self.width), bits)
+        self.bits = bits
+
+    def add(self, ids, values=None):
+        """
+        Pristeje stetja k-gramov
+
+        :param ids matrika id-jev besed, vsaka vrstica je en k-gram
+        :param values stevila pojavitev k-gramov (privzeto vsaka vrstica enkrat)
+        """
+        keys = pack_kgrams(ids, self.bits)
+        if values is None:
+            values = numpy.ones(len(keys), dtype=numpy.int64)
+        self.pending.append(sum_counts(keys, values.astype(numpy.int64)))
+        if sum(len(x) for x, _ in self.pending) > len(self.keys):
+            self.merge()
+
+    def merge(self):
+        """ Zdruzi dodana stetja z urejenimi stetji """
+        if self.pending:
+            self.keys, self.values = sum_counts(numpy.concatenate([self.keys] + [x for x, _ in self.pending]),
+                                                numpy.concatenate([self.values] + [x for _, x in self.pending]))
+            self.pending = []
+
+    def ids(self):
+        """ Vrne matriko id-jev vseh k-gramov (v vrstnem redu self.values) """
+        self.merge()
+        return unpack_kgrams(self.keys, self.bits, self.width)
+
+    def get(self, ids):
+        """ Vrne stetja k-gramov v vrsticah matrike id-jev (0 za k-grame, ki jih ni) """
+        self.merge()
+        keys = pack_kgrams(ids, self.bits)
+        if len(self.keys) == 0:
+            return numpy.zeros(len(keys), dtype=numpy.int64)
+        i = numpy.searchsorted(self.keys, keys)
+        i[i == len(self.keys)] = 0
+        return numpy.where(self.keys[i] == keys, self.values[i], 0)
+
+    def __len__(self):
+        self.merge()
+        return len(self.keys)
+
+
+class MappedVocabulary:
+    """ Urejen besednjak v binarni datoteki, id besede je njen indeks (iscemo z bisekcijo) """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def index(self, word):
+        """ Vrne id besede ali None, ce je ni v besednjaku """
+        i = bisect.bisect_left(self, word)
+        if i < len(self) and self[i] == word:
+            return i
+        return None
+
+
+class MappedCounts:
+    """
+    Tabela k-gramov v binarni datoteki, ki se obnasa kot slovar k-gram -> stevilo.
+    Kljuci so urejeni zapakirani id-ji, zato iscemo z bisekcijo brez deserializacije.
+    """
+
+    def __init__(self, vocabulary, bits, width, packed, values, unk=None, codebook=None):
+        self.vocabulary = vocabulary
+        self.bits = bits
+        self.width = width
+        self.packed = packed
+        self.values = values
+        self.unk = unk
+        # Pri kvantiziranem modelu so values kode, vrednosti so v kodirni knjigi (glej quantize)
+        self.codebook = codebook
+
+    def value_array(self, i):
+        """ Vrne vrednosti na mestih i (kode kvantiziranega modela prevede s kodirno knjigo) """
+        values = self.values[i]
+        return values if self.codebook is None else self.codebook[values]
+
+    def encode(self, kgram):
+        """ Vrne zapakiran kljuc k-grama (tabela z enim kljucem) ali None, ce katere od besed ni v besednjaku """
+        if not isinstance(kgram, tuple) or len(kgram) != self.width:
+            return None
+        ids = []
+        for word in kgram:
+            i = self.vocabulary.index(word)
+            if i is None:
+                return None
+            ids.append(i)
+        return pack_kgrams(numpy.array(ids, dtype=numpy.uint64).reshape(1, self.width), self.bits)
+
+    def decode(self, key):
+        """ Pretvori zapakiran kljuc (glej key_dtype) nazaj v k-gram besed """
+        mask = (1 << self.bits) - 1
+        per_word = 64 // self.bits
+        ids = []
+        for i, word in enumerate(key.item() if self.packed.dtype.names else (int(key),)):
+            part = []
+            for _ in range(min(per_word, self.width - i * per_word)):
+                part.append(word & mask)
+                word >>= self.bits
+            ids.extend(reversed(part))
+        return tuple(self.vocabulary[i] for i in ids)
+
+    def get(self, kgram, default=None):
+        if kgram == 'UNK':
+            return default if self.unk is None else self.unk
+        key = self.encode(kgram)
+        if key is None:
+            return default
+        i = numpy.searchsorted(self.packed, key)[0]
+        if i < len(self.packed) and self.packed[i:i + 1] == key:
+            return self.value_array(i).item()
+        return default
+
+    def __getitem__(self, kgram):
+        return self.get(kgram, 0)
+
+    def __contains__(self, kgram):
+        return self.get(kgram) is not None
+
+    def __len__(self):
+        return len(self.packed) + (self.unk is not None)
+
+    def items(self):
+        for key, value in zip(self.packed, self.value_array(slice(None))):
+            yield self.decode(key), value.item()
+        if self.unk is not None:
+            yield 'UNK', self.unk
+
+    def keys(self):
+        return (kgram for kgram, _ in self.items())
+
+    def __iter__(self):
+        return self.keys()
 
 
 class LanguageModel:
     table = str.maketrans('', '')
+    index_names = ('continuations', 'left_contexts', 'context_totals')
+    final_names = ('log_probs', 'backoffs')
 
-    def __init__(self, n=3):
+    def __init__(self, n=3, cache_size=100000):
         # Velikost n-gramov
         self.n_size = n
         self.n_grams = [defaultdict(int) for _ in range(n)]   # 0 - unigrams, 1 - bigrams, 2 - trigrams .. n-1 - n-grams
+        # Indeksi za glajenje Kneser-Ney (za vsako stopnjo k, glej build_index)
+        self.continuations = [{} for _ in range(n)]
+        self.left_contexts = [{} for _ in range(n)]
+        self.context_totals = [{} for _ in range(n)]
+        # Meja pojavitev: k-grami s threshold ali manj pojavitvami so odrezani (glej prune_counts in prune)
+        self.threshold = 2
+        # Surova stetja pred rezanjem (KGramCounts za vsako stopnjo), potrebna za posodabljanje modela
+        self.raw_counts = None
+        self.raw_vocabulary = None
+        # Tabele v obliki urejenih kljucev za vektorsko ocenjevanje (glej compiled_tables)
+        self.compiled = None
+        # Predpomnilnik zglajenih verjetnosti (d, k, k-gram) -> verjetnost, z izrivanjem najstarejsih (LRU)
+        self.cache_size = cache_size
+        self.prob_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Koncne tabele log10 verjetnosti in utezi sestopa (glej finalize) ter popusti po stopnjah
+        self.log_probs = None
+        self.backoffs = None
+        self.discounts = None
+
+    def invalidate(self):
+        """ Zavrze izpeljane podatke, ko se model spremeni """
+        self.compiled = None
+        self.prob_cache.clear()
+        self.log_probs = None
+        self.backoffs = None
+        self.discounts = None
+
+    def cache_info(self):
+        """ Vrne statistiko predpomnilnika verjetnosti """
+        return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                'size': len(self.prob_cache), 'max_size': self.cache_size}
 
     def make_ngrams(self, sentence, n):
         """ Ustvari ngrame in jih vrne kot seznam stringov"""
@@ -39,93 +444,714 @@ class LanguageModel:
         for i in range(len(words) - n + 1):
             counter_dict[tuple((words[i:i+n]))] += 1
 
-    def get_sentences(self, file):
-        """ Vrne vse povedi v datoteki (pricakuje se slovensko besedilo """
-        slovene_tokenizer = nltk.data.load('tokenizers/punkt/slovene.pickle')
-        remove_punc = str.maketrans("", "", string.punctuation + '»«−…•')
-        sentences = slovene_tokenizer.tokenize(''.join(file.readlines()))
-        return [s.translate(remove_punc) for s in sentences]
+    def new_counts(self):
+        """ Vrne prazna surova stetja za vse stopnje (glej KGramCounts) """
+        return [KGramCounts(k + 1) for k in range(self.n_size)]
+
+    def count_sentences(self, sentences, counts, vocabulary):
+        """
+        Presteje vse k-grame (1..n) paketa povedi. Besede pretvori v id-je, k-grame pa vektorsko presteje
+        kot okna dolzine k v tabeli id-jev vseh povedi, ki ne prekoracijo meje povedi.
+        """
+        words, lengths = [], []
+        for sentence in sentences:
+            sentence_words = ('<s> ' + sentence.rstrip() + ' </s>').split()
+            words.extend(sentence_words)
+            lengths.append(len(sentence_words))
+        # Nove besede dodamo v besednjak v vrstnem redu pojavitve, nato id-je vseh besed poiscemo naenkrat
+        for word in dict.fromkeys(words):
+            vocabulary.intern(word)
+        ids = numpy.fromiter(map(vocabulary.ids.__getitem__, words), dtype=numpy.uint64, count=len(words))
+        owners = numpy.repeat(numpy.arange(len(lengths)), lengths)
+        for k, table in enumerate(counts):
+            table.widen(vocabulary.bits())
+            if len(ids) > k:
+                windows = numpy.lib.stride_tricks.sliding_window_view(ids, k + 1)
+                table.add(windows[owners[:len(windows)] == owners[k:]])
+
+    def count_file(self, filename, counts, vocabulary, batch_size=10000):
+        """ Presteje k-grame vseh povedi v datoteki (v paketih po batch_size povedi, glej count_sentences) """
+        batch = []
+        with open(filename) as f:
+            for sentence in self.get_sentences(f):
+                batch.append(sentence)
+                if len(batch) == batch_size:
+                    self.count_sentences(batch, counts, vocabulary)
+                    batch = []
+        if batch:
+            self.count_sentences(batch, counts, vocabulary)
+
+    def merge_counts(self, counts, vocabulary, shard_counts, shard_words):
+        """ Pristeje stetja iz drugega procesa, lokalne id-je preslika v id-je skupnega besednjaka """
+        mapping = numpy.array([vocabulary.intern(word) for word in shard_words], dtype=numpy.uint64)
+        for table, shard in zip(counts, shard_counts):
+            table.widen(vocabulary.bits())
+            ids = shard.ids()
+            table.add(mapping[ids], shard.values)
 
-    def train(self, folder='korpus/'):
-        """ Prebere vse tekstovne datoteke znotraj corpus_folder in zgradi model """
+    def prune_counts(self, counts, vocabulary, threshold=2):
+        """ Odstrani k-grame, ki se pojavijo threshold ali manjkrat, ostale pretvori v besede in doda UNK """
+        n_grams = []
+        for table in counts:
+            ids = table.ids()
+            kept = table.values > threshold
+            kgrams = (tuple(vocabulary.words[i] for i in row) for row in ids[kept].tolist())
+            n_grams.append(defaultdict(int, zip(kgrams, table.values[kept].tolist())))
+            # Dodaj nazaj UNK, ki ima stevilo pojavitev enako meji
+            n_grams[-1]['UNK'] = threshold
+        return n_grams
+
+    def get_sentences(self, file, chunk_size=1 << 20):
+        """
+        Generator povedi v datoteki (pricakuje se slovensko besedilo). Datoteko bere po kosih
+        chunk_size znakov, zadnjo (morda nedokoncano) poved kosa pa prenese v naslednji kos,
+        zato je poraba pomnilnika neodvisna od velikosti datoteke.
+        """
+        tokenizer = slovene_tokenizer()
+        carry = ''
+        while True:
+            chunk = file.read(chunk_size)
+            text = carry + chunk
+            if not chunk:
+                for sentence in tokenizer.tokenize(text):
+                    yield sentence.translate(REMOVE_PUNCTUATION)
+                return
+            spans = list(tokenizer.span_tokenize(text))
+            for begin, end in spans[:-1]:
+                yield text[begin:end].translate(REMOVE_PUNCTUATION)
+            carry = text[spans[-1][0]:] if spans else text
+            if len(carry) > chunk_size:
+                # Besedilo brez konca povedi ne kopicimo v nedogled
+                yield carry.translate(REMOVE_PUNCTUATION)
+                carry = ''
+
+    @stats.timed('kneser_ney.train')
+    def train(self, folder='korpus/', processes=1, keep_counts=False):
+        """
+        Prebere vse tekstovne datoteke znotraj corpus_folder in zgradi model
+
+        :param processes stevilo procesov; ce je vec kot 1, datoteke prestejejo procesi v bazenu,
+                         delna stetja pa zdruzimo pred rezanjem (None uporabi vsa jedra)
+        :param keep_counts ce je True, obdrzi surova stetja pred rezanjem (potrebna za update, finalize
+                           z njimi oceni popuste), ki so lahko precej vecja od modela
+        """
         print('Learning from .txt files ...', end='')
         start = timer()
         txt_files = glob.glob(folder + '*.txt')
-        for filename in txt_files:
-            with open(filename) as f:
-                sentences = self.get_sentences(f)
-                for sentence in sentences:
-                    # Zgradi besedne unigram, bigram ... n-gram
-                    for k in range(self.n_size):
-                        # Izgradi k-gram (1..n) in ga dodaj v ustrezno mesto
-                        # K+1, ker stejemo od 0
-                        self.count_ngrams(sentence, k+1, self.n_grams[k])
+        vocabulary = Vocabulary()
+        counts = self.new_counts()
+        self.count_files(txt_files, counts, vocabulary, processes)
+        # Surova stetja obdrzimo le na zahtevo, za kasnejse posodobitve (glej update)
+        self.raw_counts = counts if keep_counts else None
+        self.raw_vocabulary = vocabulary if keep_counts else None
         # Ngrame, ki se pojavijo 2 ali manjkrat odstrani in nadomesti z UNK (na vsakem nivoju)
-        for kgram_count in self.n_grams:
-            ngrams_to_cut = []
+        self.threshold = 2
+        self.n_grams = self.prune_counts(counts, vocabulary, self.threshold)
+        self.build_index()
+        self.invalidate()
+
+        print(' %.2fs' % (timer() - start))
+
+    def count_files(self, filenames, counts, vocabulary, processes=1):
+        """ Presteje k-grame v datotekah, po potrebi v bazenu procesov """
+        if processes == 1:
+            for filename in filenames:
+                self.count_file(filename, counts, vocabulary)
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                jobs = [(filename, self.n_size) for filename in filenames]
+                for shard_words, shard_counts in pool.imap_unordered(count_shard, jobs):
+                    self.merge_counts(counts, vocabulary, shard_counts, shard_words)
+
+    @stats.timed('kneser_ney.update')
+    def update(self, filenames, processes=1, threshold=None):
+        """
+        Doda nova besedila v obstojec model brez ponovnega ucenja na celotnem korpusu.
+        Nova stetja pristeje surovim stetjem, rezanje ponovi le za spremenjene k-grame
+        in indekse Kneser-Ney popravi le za njihove kontekste.
+
+        :param filenames seznam novih tekstovnih datotek
+        :param threshold meja pojavitev (privzeto meja modela, ki jo prune po potrebi zvisa)
+        """
+        if threshold is None:
+            threshold = self.threshold
+        if self.raw_counts is None:
+            raise ValueError('Model nima surovih stetij (uci ga s keep_counts=True ali jih nalozi z load_counts)')
+        print('Updating model ...', end='')
+        start = timer()
+        delta = self.new_counts()
+        self.count_files(filenames, delta, self.raw_vocabulary, processes)
+
+        # Preslikane tabele binarnega modela so samo za branje
+        self.n_grams = [x if isinstance(x, dict) else defaultdict(int, x.items()) for x in self.n_grams]
+        for name in self.index_names:
+            setattr(self, name, [x if isinstance(x, dict) else dict(x.items()) for x in getattr(self, name)])
+
+        words = self.raw_vocabulary.words
+        for raw, table in zip(self.raw_counts, delta):
+            raw.widen(self.raw_vocabulary.bits())
+            ids = table.ids()
+            raw.add(ids, table.values)
+            # Nova skupna stetja spremenjenih k-gramov
+            totals = raw.get(ids)
+            changed = totals > threshold
+            for row, total in zip(ids[changed].tolist(), totals[changed].tolist()):
+                kgram = tuple(words[i] for i in row)
+                k = len(kgram) - 1
+                previous = self.n_grams[k].get(kgram, 0)
+                self.n_grams[k][kgram] = total
+                if previous == 0:
+                    # K-gram je na novo presegel mejo, zato je nov tudi v kontekstih
+                    self.continuations[k][kgram[:-1]] = self.continuations[k].get(kgram[:-1], 0) + 1
+                    self.left_contexts[k][kgram[1:]] = self.left_contexts[k].get(kgram[1:], 0) + 1
+                self.context_totals[k][kgram[:-1]] = self.context_totals[k].get(kgram[:-1], 0) + total - previous
+        self.invalidate()
+        print(' %.2fs' % (timer() - start))
+
+    def prune(self, max_ngrams=None, max_mb=None, bits=None):
+        """
+        Obreze model na dano velikost. Vse k-grame, ki se pojavijo threshold ali manjkrat, odstrani
+        (enako kot prune_counts, le z vecjo mejo), pri cemer izbere najmanjso mejo, pri kateri ima model
+        najvec max_ngrams k-gramov (vkljucno z UNK vsake stopnje) in je binarni model (s kvantizacijo bits)
+        manjsi od max_mb MB. Velikost je ocenjena (glej binary_size), shrink pa preveri tudi zapisano datoteko.
+        Ker ima k-gram najvec toliko pojavitev kot njegova predpona, ostanejo konteksti vseh ohranjenih k-gramov.
+
+        :return meja pojavitev (ohranjeni so k-grami z vec pojavitvami)
+        """
+        tables = [{kgram: occurrence for kgram, occurrence in x.items() if isinstance(kgram, tuple)}
+                  for x in self.n_grams]
+        # Dokoncan model (glej finalize) shranimo tudi s koncnimi tabelami
+        final = self.log_probs is not None
+        # Kandidati za mejo so vse razlicne vrednosti stetij, velikost modela z mejo pa pada
+        candidates = numpy.unique(numpy.concatenate([[0]] + [list(x.values()) for x in tables]))
+
+        def fits(threshold):
+            kept = [{kgram: occurrence for kgram, occurrence in x.items() if occurrence > threshold} for x in tables]
+            # Vsaka stopnja ima tudi vnos UNK
+            if max_ngrams is not None and sum(len(x) for x in kept) + len(kept) > max_ngrams:
+                return False
+            if max_mb is not None and self.binary_size(kept, bits, final) > max_mb * (1 << 20):
+                return False
+            return True
+
+        # Bisekcija po kandidatih (najmanjsa meja, pri kateri model ustreza omejitvam)
+        low, high = 0, len(candidates) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if fits(candidates[middle]):
+                high = middle
+            else:
+                low = middle + 1
+        threshold = int(candidates[low])
+        if not fits(threshold):
+            raise ValueError('Model ni mogoce obrezati na zahtevano velikost')
+        self.prune_threshold(threshold)
+        return threshold
+
+    def prune_threshold(self, threshold):
+        """
+        Odstrani k-grame, ki se pojavijo threshold ali manjkrat (glej prune), in ponovno zgradi indekse.
+        Mejo si zapomni, da update ne doda nazaj odrezanih k-gramov.
+        """
+        self.threshold = max(self.threshold, threshold)
+        tables = [{kgram: occurrence for kgram, occurrence in x.items() if isinstance(kgram, tuple)}
+                  for x in self.n_grams]
+        unks = [x.get('UNK') or 0 for x in self.n_grams]
+        self.n_grams = []
+        for x, unk in zip(tables, unks):
+            kept = defaultdict(int, {kgram: occurrence for kgram, occurrence in x.items() if occurrence > threshold})
+            # UNK ima stevilo pojavitev enako meji (kot v prune_counts)
+            kept['UNK'] = max(threshold, unk)
+            self.n_grams.append(kept)
+        self.build_index()
+        self.invalidate()
+
+    @staticmethod
+    def binary_size(tables, bits=None, final=False):
+        """
+        Oceni velikost binarnega modela (glej build_arrays) v bajtih iz tabel stetij k-gramov (brez UNK)
+
+        :param tables seznam slovarjev k-gram -> stevilo pojavitev za vsako stopnjo
+        :param bits kvantizacija vrednosti (8, 16 ali None)
+        :param final ali model shranimo s koncnimi tabelami (glej finalize)
+        """
+        value_bytes = bits // 8 if bits else 8
+        size = len(MODEL_MAGIC) + 16 + 256
+        # Besednjak: UTF-8 bajti in odmik vsake besede
+        size += sum(len(kgram[0].encode('utf-8')) + 8 for kgram in tables[0]) + 8
+        id_bits = max(1, len(tables[0]).bit_length())
+        for k, kgram_count in enumerate(tables):
+            continuations, left_contexts, context_totals = Counter(), Counter(), defaultdict(int)
+            for kgram, occurrence in kgram_count.items():
+                continuations[kgram[:-1]] += 1
+                left_contexts[kgram[1:]] += 1
+                context_totals[kgram[:-1]] += occurrence
+            for table, width in ((kgram_count, k + 1), (continuations, k), (left_contexts, k), (context_totals, k)):
+                # Kljuc (glej key_dtype) in vrednost vsakega vnosa, poravnava na 8 bajtov in opis tabel v glavi
+                size += len(table) * (key_dtype(id_bits, width).itemsize + value_bytes) + 2 * (8 + 64)
+                if bits:
+                    # Kodirna knjiga (int64) in njen opis v glavi
+                    size += min(len(set(table.values())), 1 << bits) * 8 + 8 + 64
+            if final:
+                # Koncne tabele: verjetnost vsakega k-grama (unigrami tudi <unk>) in utez sestopa vsakega
+                # konteksta (float32 ali kode), kodirna knjiga je najvec velikosti 2^bits
+                final_bytes = bits // 8 if bits else 4
+                for entries, width in ((len(kgram_count) + (k == 0), k + 1), (len(continuations) * (k > 0), k)):
+                    size += entries * (key_dtype(id_bits, width).itemsize + final_bytes) + 2 * (8 + 64)
+                    if bits:
+                        size += min(entries, 1 << bits) * 8 + 8 + 64
+        return size
+
+    def shrink(self, filename, test_file, max_ngrams=None, max_mb=None, bits=8):
+        """
+        Obreze model (glej prune), ga shrani kvantiziranega v filename in izpise spremembo velikosti
+        in perpleksnosti na test_file (file_perplexity pred in po). Dokoncan model (glej finalize) po rezanju
+        dokonca znova, zato ima tudi manjsi model koncne tabele in obe perpleksnosti sta izracunani enako.
+
+        :return slovar z mejo, stevilom k-gramov, velikostjo datoteke v MB in perpleksnostma
+        """
+        finalized = self.log_probs is not None
+        before = self.file_perplexity(test_file)
+        ngrams_before = sum(len(x) for x in self.n_grams)
+        threshold = self.prune(max_ngrams, max_mb, bits)
+        if finalized:
+            self.finalize()
+        self.save_binary(filename, bits)
+        # Ocena velikosti je lahko premajhna, zato mejo dvigujemo, dokler datoteka ni dovolj majhna
+        while max_mb is not None and os.path.getsize(filename) > max_mb * (1 << 20):
+            remaining = [occurrence for x in self.n_grams for kgram, occurrence in x.items() if isinstance(kgram, tuple)]
+            if not remaining:
+                raise ValueError('Model ni mogoce obrezati na %g MB' % max_mb)
+            threshold = min(remaining)
+            self.prune_threshold(threshold)
+            if finalized:
+                self.finalize()
+            self.save_binary(filename, bits)
+        small = LanguageModel(self.n_size)
+        small.read_from_file(filename)
+        after = small.file_perplexity(test_file)
+        report = {'threshold': threshold, 'ngrams': sum(len(x) for x in self.n_grams),
+                  'size_mb': os.path.getsize(filename) / (1 << 20), 'perplexity_before': before,
+                  'perplexity_after': after}
+        print('Pruned to %d n-grams (from %d, threshold %d), %.2f MB, perplexity %g -> %g (x%.4g)' % (
+            report['ngrams'], ngrams_before, threshold, report['size_mb'], before, after, after / before))
+        return report
+
+    def save_counts(self, filename):
+        """ Shrani surova stetja (pred rezanjem) v binarno datoteko ob modelu """
+        if self.raw_counts is None:
+            raise ValueError('Model nima surovih stetij (uci ga s keep_counts=True ali jih nalozi z load_counts)')
+        arrays = OrderedDict()
+        arrays['vocab_data'], arrays['vocab_offsets'] = vocabulary_arrays(self.raw_vocabulary.words)
+        for k, table in enumerate(self.raw_counts):
+            arrays['counts_%d_ids' % k] = table.ids().astype(numpy.uint32).ravel()
+            arrays['counts_%d_values' % k] = table.values
+        write_arrays(filename, {'n': self.n_size}, arrays)
+
+    def load_counts(self, filename):
+        """ Prebere surova stetja, ki jih je shranil save_counts (potrebna za update) """
+        _, header, arrays = map_arrays(filename)
+        words = MappedVocabulary(arrays['vocab_data'], arrays['vocab_offsets'])
+        self.raw_vocabulary = Vocabulary()
+        for i in range(len(words)):
+            self.raw_vocabulary.intern(words[i])
+        self.raw_counts = []
+        for k in range(header['n']):
+            table = KGramCounts(k + 1, self.raw_vocabulary.bits())
+            table.add(arrays['counts_%d_ids' % k].reshape(-1, k + 1), arrays['counts_%d_values' % k])
+            self.raw_counts.append(table)
+
+    def build_index(self):
+        """
+        Zgradi indekse za Kneser-Ney, da je izracun verjetnosti O(1) na stopnjo.
+        Za vsako stopnjo k hrani stevilo unikatnih nadaljevanj konteksta, stevilo unikatnih
+        levih kontekstov (k-1)-grama in vsoto pojavitev vseh nadaljevanj konteksta.
+        """
+        self.continuations = [defaultdict(int) for _ in range(self.n_size)]
+        self.left_contexts = [defaultdict(int) for _ in range(self.n_size)]
+        self.context_totals = [defaultdict(int) for _ in range(self.n_size)]
+        for k, kgram_count in enumerate(self.n_grams):
             for kgram, occurrence in kgram_count.items():
-                if occurrence <= 2:
-                    ngrams_to_cut.append(kgram)
-            # Pobrisi ven kljuce, ki se pojavijo <= 2
-            for k in ngrams_to_cut:
-                kgram_count.pop(k)
-            # Dodaj nazaj UNK, ki ima stevilo pojavitev 2 (mejo)
-            kgram_count['UNK'] = 2
+                # UNK ni pravi k-gram, zato ga ne stejemo v kontekste
+                if not isinstance(kgram, tuple) or len(kgram) != k + 1:
+                    continue
+                self.continuations[k][kgram[:-1]] += 1
+                self.left_contexts[k][kgram[1:]] += 1
+                self.context_totals[k][kgram[:-1]] += occurrence
+        # Pri poizvedbah ne zelimo dodajati novih kljucev
+        self.continuations = [dict(x) for x in self.continuations]
+        self.left_contexts = [dict(x) for x in self.left_contexts]
+        self.context_totals = [dict(x) for x in self.context_totals]
+
+    def adjusted_counts(self):
+        """
+        Vrne prilagojena stetja Kneser-Ney shranjenih k-gramov in stetja stetij (count-of-counts) po stopnjah.
+        Najvisja stopnja ima prava stetja, nizje pa stevilo razlicnih levih kontekstov (k-grami z <s> na
+        zacetku levega konteksta nimajo, zato ohranijo pravo stetje). Ce imamo surova stetja (glej train
+        in load_counts), racunamo iz njih, sicer iz obrezanih tabel in indeksov.
+        """
+        adjusted, statistics = [], []
+        # Preslikane tabele preberemo naenkrat, posamezne poizvedbe po njih so pocasnejse
+        n_grams = [x if isinstance(x, dict) else dict(x.items()) for x in self.n_grams]
+        for k in range(self.n_size):
+            highest = k == self.n_size - 1
+            kgrams = [kgram for kgram in n_grams[k] if isinstance(kgram, tuple)]
+            if self.raw_counts is not None:
+                raw = self.raw_counts[k]
+                if highest:
+                    left = raw
+                else:
+                    # Levi konteksti: stevilo razlicnih (k+2)-gramov, ki se koncajo s k-gramom
+                    left = KGramCounts(k + 1, raw.bits)
+                    left.add(self.raw_counts[k + 1].ids()[:, 1:])
+                ids = numpy.array([[self.raw_vocabulary.ids[word] for word in kgram] for kgram in kgrams],
+                                  dtype=numpy.uint64).reshape(len(kgrams), k + 1)
+                starts = numpy.array([kgram[0] == '<s>' for kgram in kgrams], dtype=bool)
+                counts = numpy.where(starts, raw.get(ids), left.get(ids)).tolist()
+                values, occurrences = numpy.unique(left.values, return_counts=True)
+                statistics.append(Counter(dict(zip(values.tolist(), occurrences.tolist()))))
+            else:
+                table = n_grams[k] if highest else self.left_contexts[k + 1]
+                if not isinstance(table, dict):
+                    table = dict(table.items())
+                counts = [n_grams[k][kgram] if kgram[0] == '<s>' else table.get(kgram, 0) for kgram in kgrams]
+                statistics.append(Counter(counts))
+            adjusted.append(dict(zip(kgrams, counts)))
+        return adjusted, statistics
 
+    @staticmethod
+    def estimate_discount(count_of_counts, default=0.75):
+        """
+        Oceni popust iz stetij stetij: D = n1 / (n1 + 2 * n2). Ce k-gramov z enim ali dvema pojavitvama
+        ni (npr. so bili odrezani), vrne default.
+        """
+        n1, n2 = count_of_counts.get(1, 0), count_of_counts.get(2, 0)
+        if n1 == 0 or n2 == 0:
+            return default
+        return n1 / (n1 + 2 * n2)
+
+    @stats.timed('kneser_ney.finalize')
+    def finalize(self):
+        """
+        Vnaprej izracuna interpolirane Kneser-Ney verjetnosti (log10, kot v formatu ARPA) in utezi sestopa
+        za vse shranjene k-grame, s popustom za vsako stopnjo (glej estimate_discount). Poizvedba je potem
+        le nekaj iskanj po tabelah (glej backoff_log_prob), tabele pa lahko izvozimo v ARPA (glej save_arpa).
+        Ko se model spremeni (update, prune), jih je treba izracunati znova.
+        """
+        print('Finalizing model ...', end='')
+        start = timer()
+        adjusted, statistics = self.adjusted_counts()
+        discounts = [self.estimate_discount(x) for x in statistics]
+        self.invalidate()
+        # Nizje stopnje so ze izracunane, ko jih potrebujemo pri visjih (backoff_log_prob)
+        self.log_probs = [{} for _ in range(self.n_size)]
+        self.backoffs = [{} for _ in range(self.n_size)]
+        for k, counts in enumerate(adjusted):
+            d = discounts[k]
+            if k == 0:
+                # <s> ne napovedujemo, zato ne dobi dela verjetnostne mase
+                start_symbol = counts.pop(('<s>',), None)
+            totals, nonzero = defaultdict(int), defaultdict(int)
+            for kgram, count in counts.items():
+                totals[kgram[:-1]] += count
+                nonzero[kgram[:-1]] += count > 0
+            if k == 0:
+                # Unigrame interpoliramo z enakomerno porazdelitvijo (vkljucno z <unk>)
+                total = totals[()]
+                uniform = d * nonzero[()] / total / (len(counts) + 1)
+                for kgram, count in counts.items():
+                    self.log_probs[0][kgram] = math.log10(max(count - d, 0) / total + uniform)
+                self.log_probs[0][('<unk>',)] = math.log10(uniform)
+                if start_symbol is not None:
+                    self.log_probs[0][('<s>',)] = ARPA_START_LOG_PROB
+                continue
+            for kgram, count in counts.items():
+                total = totals[kgram[:-1]]
+                lower = 10 ** self.backoff_log_prob(kgram[1:])
+                if total == 0:
+                    prob = lower
+                else:
+                    prob = max(count - d, 0) / total + d * nonzero[kgram[:-1]] / total * lower
+                self.log_probs[k][kgram] = math.log10(prob)
+            for context, total in totals.items():
+                if total > 0:
+                    self.backoffs[k - 1][context] = math.log10(d * nonzero[context] / total)
+        self.discounts = discounts
         print(' %.2fs' % (timer() - start))
 
-    def save_to_file(self, filename):
-        """ Shrani model v datoteke """
+    def backoff_log_prob(self, kgram):
+        """
+        Vrne log10 verjetnosti zadnje besede k-grama iz koncnih tabel (glej finalize). Ce k-grama ni,
+        pristeje utez sestopa njegovega konteksta in poskusi s krajsim k-gramom.
+        """
+        backoff = 0.0
+        for begin in range(len(kgram)):
+            suffix = kgram[begin:]
+            log_prob = self.log_probs[len(suffix) - 1].get(suffix)
+            if log_prob is not None:
+                return backoff + log_prob
+            if len(suffix) > 1:
+                backoff += self.backoffs[len(suffix) - 2].get(suffix[:-1], 0.0)
+        return backoff + self.unknown_log_prob()
+
+    def unknown_log_prob(self):
+        """ Vrne log10 verjetnosti neznane besede (<unk>) iz koncnih tabel """
+        log_prob = self.log_probs[0].get(('<unk>',))
+        if log_prob is None:
+            raise ValueError('Koncne tabele modela nimajo verjetnosti <unk>')
+        return log_prob
+
+    @stats.timed('kneser_ney.save_to_file')
+    def save_to_file(self, filename, binary=True, bits=None, counts=False):
+        """
+        Shrani model v datoteko
+
+        :param binary ce je True, shrani v binarni format (glej save_binary), drugace v JSON
+        :param bits ce je 8 ali 16, so vrednosti binarnega modela kvantizirane (glej quantize)
+        :param counts ce je True, ob modelu shrani tudi surova stetja (filename + '.counts', glej save_counts)
+        """
         print('Dumping model into files ...', end='')
         start = timer()
-        model_out = {'n': self.n_size, 'n_grams': [{' '.join(k): v for k, v in x.items()} for x in self.n_grams]}
+        if binary:
+            self.save_binary(filename, bits)
+        else:
+            self.save_json(filename)
+        if counts:
+            # Surova stetja shranimo ob modelu, da ga lahko kasneje posodobimo
+            self.save_counts(filename + '.counts')
+        print(' %.2fs' % (timer() - start))
+
+    def save_json(self, filename):
+        """ Shrani model v JSON datoteko (n-grami so nizi besed, locenih s presledki) """
+        model_out = {'n': self.n_size, 'threshold': self.threshold, 'n_grams': [{' '.join(k): v for k, v in x.items()} for x in self.n_grams],
+                     'index': {name: [{' '.join(k): v for k, v in x.items()} for x in getattr(self, name)]
+                               for name in self.index_names}}
         with open(filename, 'w', encoding='utf-8') as f:
             json.dump(model_out, f, ensure_ascii=False)
-        print(' %.2fs' % (timer() - start))
 
+    def save_binary(self, filename, bits=None):
+        """
+        Shrani model v binarno datoteko, ki jo lahko odpremo z mmap.
+        Besede so v urejenem besednjaku (id je indeks besede), vsak k-gram pa je zapakiran v en uint64
+        kljuc (pri velikem besednjaku v vec uint64 besed, glej key_dtype). Za vsako stopnjo shranimo urejene
+        kljuce in pripadajoca stevila (z bits=8 ali 16 le kode v kodirno knjigo stopnje), na koncu pa se
+        JSON glavo z opisom tabel (tip, dolzina, odmik v datoteki).
+        """
+        header, arrays = self.build_arrays(bits)
+        write_arrays(filename, header, arrays)
+
+    def build_arrays(self, bits=None):
+        """ Pretvori tabele modela v urejene zapakirane kljuce in vrednosti (glej save_binary) """
+        quantization = bits
+        names = self.index_names + (self.final_names if self.log_probs is not None else ())
+        tables = OrderedDict([('n_grams', self.n_grams)] + [(name, getattr(self, name)) for name in names])
+        words = sorted({word for table in tables.values() for kgram_count in table for kgram in kgram_count
+                        if isinstance(kgram, tuple) for word in kgram})
+        ids = {word: i for i, word in enumerate(words)}
+        bits = max(1, len(words).bit_length())
+
+        arrays = OrderedDict()
+        arrays['vocab_data'], arrays['vocab_offsets'] = vocabulary_arrays(words)
+        for name, table in tables.items():
+            for k, kgram_count in enumerate(table):
+                # n-grami (in koncne tabele) stopnje k imajo k+1 besed, konteksti v indeksih pa k besed
+                width = k if name in self.index_names else k + 1
+                kgrams = [kgram for kgram in kgram_count if isinstance(kgram, tuple) and len(kgram) == width]
+                matrix = numpy.array([[ids[word] for word in kgram] for kgram in kgrams], dtype=numpy.uint64)
+                keys = pack_kgrams(matrix.reshape(len(kgrams), width), bits)
+                order = numpy.argsort(keys)
+                arrays['%s_%d_keys' % (name, k)] = keys[order]
+                dtype = numpy.float32 if name in self.final_names else numpy.int64
+                values = numpy.array([kgram_count[x] for x in kgrams], dtype=dtype)[order]
+                if quantization:
+                    values, arrays['%s_%d_codebook' % (name, k)] = quantize(values, quantization)
+                arrays['%s_%d_values' % (name, k)] = values
+
+        header = {'n': self.n_size, 'bits': bits, 'unk': [x.get('UNK') for x in self.n_grams],
+                  'quantization': quantization, 'discounts': self.discounts, 'threshold': self.threshold}
+        return header, arrays
+
+    @stats.timed('kneser_ney.read_from_file')
     def read_from_file(self, filename):
-        """ Prebere model, ki ga je shranil, iz datoteke """
+        """
+        Prebere model, ki ga je shranil, iz datoteke (binarni format ali JSON).
+        Surovih stetij ne bere, za posodabljanje jih nalozimo z load_counts(filename + '.counts').
+        """
         print("Loading model from file ...", end='')
         start = timer()
+        self.raw_counts = None
+        self.raw_vocabulary = None
+        self.invalidate()
+        with open(filename, 'rb') as f:
+            head = f.read(len(MODEL_MAGIC))
+        if head == MODEL_MAGIC:
+            self.read_binary(filename)
+        elif head.lstrip().startswith(b'{'):
+            self.read_json(filename)
+        else:
+            self.read_arpa(filename)
+        print(' %.2fs' % (timer() - start))
+
+    def save_arpa(self, filename):
+        """ Shrani koncne tabele (glej finalize) v standardnem formatu ARPA za izmenjavo z drugimi orodji """
+        if self.log_probs is None:
+            self.finalize()
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write('\n\\data\\\n')
+            for k, table in enumerate(self.log_probs):
+                f.write('ngram %d=%d\n' % (k + 1, len(table)))
+            for k, table in enumerate(self.log_probs):
+                f.write('\n\\%d-grams:\n' % (k + 1))
+                for kgram, log_prob in table.items():
+                    backoff = self.backoffs[k].get(kgram)
+                    line = '%.6f\t%s' % (log_prob, ' '.join(kgram))
+                    f.write(line + ('\t%.6f\n' % backoff if backoff is not None else '\n'))
+            f.write('\n\\end\\\n')
+
+    def read_arpa(self, filename):
+        """
+        Prebere model v formatu ARPA (npr. iz drugih orodij). Model ima le koncne tabele (glej finalize),
+        stetij in indeksov nima, zato ga ne moremo posodabljati.
+        """
+        log_probs, backoffs = [], []
+        order = 0
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line == '\\end\\':
+                    break
+                if line.startswith('\\') and line.endswith('-grams:'):
+                    order = int(line[1:-len('-grams:')])
+                    log_probs.append({})
+                    backoffs.append({})
+                    continue
+                # Glava (\data\, ngram k=...) in prazne vrstice
+                if order == 0 or not line:
+                    continue
+                fields = line.split()
+                kgram = tuple(fields[1:order + 1])
+                log_probs[order - 1][kgram] = float(fields[0])
+                if len(fields) > order + 1:
+                    backoffs[order - 1][kgram] = float(fields[order + 1])
+        if log_probs and ('<unk>',) not in log_probs[0]:
+            # Model brez <unk> neznanim besedam ne doloci verjetnosti, zato dodamo zelo majhno
+            log_probs[0][('<unk>',)] = ARPA_UNK_LOG_PROB
+        self.n_size = len(log_probs)
+        self.n_grams = [defaultdict(int) for _ in range(self.n_size)]
+        for name in self.index_names:
+            setattr(self, name, [{} for _ in range(self.n_size)])
+        self.log_probs = log_probs
+        self.backoffs = backoffs
+
+    def read_json(self, filename):
+        """ Prebere model iz JSON datoteke (uporabno tudi za pretvorbo v binarni format) """
         with open(filename, encoding='utf-8') as f:
             model = json.load(f)
             self.n_size = model['n']
-            self.n_grams = [defaultdict(int, {tuple(k.split()): v for k, v in x.items()}) for x in model['n_grams']]
-        print(' %.2fs' % (timer() - start))
+            self.threshold = model.get('threshold', 2)
+            self.n_grams = [defaultdict(int, {decode_key(k): v for k, v in x.items()}) for x in model['n_grams']]
+            if 'index' in model:
+                for name, index in model['index'].items():
+                    setattr(self, name, [{tuple(k.split()): v for k, v in x.items()} for x in index])
+            else:
+                # Starejsi modeli nimajo shranjenih indeksov
+                self.build_index()
+
+    def read_binary(self, filename):
+        """
+        Preslika binarni model v pomnilnik z mmap. Tabel ne deserializiramo, poizvedbe iscejo
+        z bisekcijo po preslikanih tabelah, zato si vec procesov deli isto kopijo v predpomnilniku.
+        """
+        self.model_map, header, arrays = map_arrays(filename)
+        self.n_size = header['n']
+        self.vocabulary, tables = self.map_tables(header, arrays)
+        self.n_grams = tables['n_grams']
+        for name in self.index_names + self.final_names:
+            setattr(self, name, tables.get(name))
+        self.discounts = header.get('discounts')
+        self.threshold = header.get('threshold', 2)
+
+    def map_tables(self, header, arrays):
+        """ Iz tabel, ki jih je zgradil build_arrays, ustvari besednjak in tabele MappedCounts """
+        bits = header['bits']
+        vocabulary = MappedVocabulary(arrays['vocab_data'], arrays['vocab_offsets'])
+        tables = {'n_grams': [MappedCounts(vocabulary, bits, k + 1, arrays['n_grams_%d_keys' % k],
+                                           arrays['n_grams_%d_values' % k], header['unk'][k],
+                                           arrays.get('n_grams_%d_codebook' % k))
+                              for k in range(header['n'])]}
+        for name in self.index_names:
+            tables[name] = [MappedCounts(vocabulary, bits, k, arrays['%s_%d_keys' % (name, k)],
+                                         arrays['%s_%d_values' % (name, k)], codebook=arrays.get('%s_%d_codebook' % (name, k)))
+                            for k in range(header['n'])]
+        for name in self.final_names:
+            if '%s_0_keys' % name in arrays:
+                tables[name] = [MappedCounts(vocabulary, bits, k + 1, arrays['%s_%d_keys' % (name, k)],
+                                             arrays['%s_%d_values' % (name, k)],
+                                             codebook=arrays.get('%s_%d_codebook' % (name, k)))
+                                for k in range(header['n'])]
+        return vocabulary, tables
+
+    def compiled_tables(self):
+        """ Vrne besednjak in tabele modela z urejenimi zapakiranimi kljuci za vektorske poizvedbe """
+        mapped = [self.n_grams[0]] + ([self.log_probs[0]] if self.log_probs is not None else [])
+        if all(isinstance(x, MappedCounts) for x in mapped):
+            names = ('n_grams',) + self.index_names + (self.final_names if self.log_probs is not None else ())
+            return self.vocabulary, {name: getattr(self, name) for name in names}
+        if self.compiled is None:
+            self.compiled = self.map_tables(*self.build_arrays())
+        return self.compiled
 
     def kneser_ney_prob(self, d, k, k_gram):
         """
-        Izracunaj Kneser-Ney glajenje
+        Izracunaj Kneser-Ney glajenje. Rezultate (tudi nizjih stopenj v rekurziji) hrani
+        v predpomnilniku velikosti cache_size, zato podobnih povedi ne racunamo vedno znova.
 
         :param d discount (float)
         :param k stopnja n-grama (k-gram)
-        :returns logaritem zglajene verjetnosti
+        :returns zglajena verjetnost
         """
+        key = (d, k, k_gram)
+        prob = self.prob_cache.get(key)
+        if prob is not None:
+            self.prob_cache.move_to_end(key)
+            self.cache_hits += 1
+            return prob
+        self.cache_misses += 1
+        prob = self.smoothed_prob(d, k, k_gram)
+        if self.cache_size > 0:
+            self.prob_cache[key] = prob
+            if len(self.prob_cache) > self.cache_size:
+                self.prob_cache.popitem(last=False)
+        return prob
+
+    def smoothed_prob(self, d, k, k_gram):
+        """ Izracuna Kneser-Ney verjetnost k-grama brez predpomnilnika (nizje stopnje gredo skozi kneser_ney_prob) """
         if k == 1:
             # Prestej kolikokrat se pojavi beseda
             # lambda(epsilon) = d, P(epsilon) - 1 / len(unigrams)
             # P_kn(unigram) = max(count(unigram) - d, 0) / count(len(unigrams) + lambda(epsilon) * P(epsilon)
             all_bigrams = len(self.n_grams[k])
             all_unigrams = len(self.n_grams[k-1])
-            continuation_count = sum([1 for x in self.n_grams[k] if k_gram[:-1] == x[:-1]])
+            # Stevilo unikatnih bigramov, ki se koncajo z besedo
+            continuation_count = self.left_contexts[k].get(k_gram, 0)
             return max(continuation_count - d, 0) / all_bigrams + d / all_unigrams
         else:
             # Zazeni rekurzijo
 
             # Kolikokrat se pojavi w_i-1
-            count_w_less_1 = self.n_grams[k-2][k_gram[:-1]]
+            count_w_less_1 = self.n_grams[k-2].get(k_gram[:-1], 0)
             if count_w_less_1 == 0:
                 count_w_less_1 = 2
 
             # Koliko unique nadaljevanj imamo za w_i-1
-            unique_completions = len([1 for x in self.n_grams[k-1].keys() if k_gram[:-1] == x[:-1]])
+            unique_completions = self.continuations[k-1].get(k_gram[:-1], 0)
             if unique_completions == 0:
                 unique_completions = 2
             lambda_weight = (d / count_w_less_1) * unique_completions
 
             # lambda(w_i-n+1) * P_kn(w_i | w_i-n+2)
             p_kn = lambda_weight * self.kneser_ney_prob(d, k-1, k_gram[1:])
-            return max(self.n_grams[k-1][k_gram] - d, 0) / count_w_less_1 + lambda_weight * p_kn
+            return max(self.n_grams[k-1].get(k_gram, 0) - d, 0) / count_w_less_1 + lambda_weight * p_kn
 
     def calculate_probability(self, ngram):
         """ Izracuna pogojno verjenost n-grama P(n|n-1,n-2...)"""
@@ -140,31 +1166,143 @@ class LanguageModel:
         log_probs = [self.calculate_probability(ngram) for ngram in ngrams]
         return math.exp(sum(log_probs))
 
+    def log_prob(self, ngram, d=0.75):
+        """ Vrne naravni logaritem verjetnosti n-grama, iz koncnih tabel (glej finalize) ali s sprotnim glajenjem """
+        if self.log_probs is not None:
+            return self.backoff_log_prob(ngram) * math.log(10)
+        return math.log(self.kneser_ney_prob(d=d, k=self.n_size, k_gram=ngram))
+
     def kn_evaluate_sentence(self, sentence):
         """ Oceni verjetnost povedi s pomocjo Kneser-Ney"""
         ngrams = self.make_ngrams(sentence, n=self.n_size)
         probs = []
         for ngram in ngrams:
-            probs.append(self.kneser_ney_prob(d=0.75, k=self.n_size, k_gram=ngram))
+            probs.append(math.exp(self.log_prob(ngram)))
         return numpy.prod(probs)
 
+    def kn_log_evaluate_sentence(self, sentence):
+        """ Oceni logaritem verjetnosti povedi s pomocjo Kneser-Ney (brez podkoracitve pri dolgih povedih) """
+        ngrams = self.make_ngrams(sentence, n=self.n_size)
+        return sum(self.log_prob(ngram) for ngram in ngrams)
+
+    def ngram_log_probs(self, words, d=0.75):
+        """ Vrne logaritme Kneser-Ney verjetnosti vseh n-gramov v seznamu besed (ze z <s> in </s>) """
+        return [self.log_prob(tuple(words[i:i + self.n_size]), d) for i in range(len(words) - self.n_size + 1)]
+
+    def kn_prob_vector(self, grams, tables, d=0.75):
+        """
+        Vektorsko izracuna enako kot kneser_ney_prob(d, n, n_gram) za vse vrstice matrike id-jev
+
+        :param grams matrika id-jev besed (uint64), vsaka vrstica je en n-gram
+        :param tables tabele, ki jih vrne compiled_tables
+        :returns zglajene verjetnosti n-gramov
+        """
+        n_grams, continuations = tables['n_grams'], tables['continuations']
+        bits = n_grams[0].bits
+        # Unigrami: stevilo unikatnih levih kontekstov zadnje besede
+        left = lookup_counts(tables['left_contexts'][1], pack_kgrams(grams[:, -1:], bits))
+        probs = numpy.maximum(left - d, 0) / len(n_grams[1]) + d / len(n_grams[0])
+        for k in range(2, self.n_size + 1):
+            suffix = grams[:, self.n_size - k:]
+            context = pack_kgrams(suffix[:, :-1], bits)
+            count_context = lookup_counts(n_grams[k - 2], context)
+            count_context[count_context == 0] = 2
+            unique_completions = lookup_counts(continuations[k - 1], context)
+            unique_completions[unique_completions == 0] = 2
+            lambda_weight = (d / count_context) * unique_completions
+            counts = lookup_counts(n_grams[k - 1], pack_kgrams(suffix, bits))
+            probs = numpy.maximum(counts - d, 0) / count_context + lambda_weight * lambda_weight * probs
+        return probs
+
+    def backoff_log_vector(self, grams, tables):
+        """
+        Vektorsko izracuna enako kot backoff_log_prob za vse vrstice matrike id-jev
+
+        :param grams matrika id-jev besed (uint64), vsaka vrstica je en n-gram
+        :param tables tabele, ki jih vrne compiled_tables (s koncnimi tabelami)
+        :returns log10 verjetnosti n-gramov
+        """
+        log_probs, backoffs = tables['log_probs'], tables['backoffs']
+        bits = log_probs[0].bits
+        result = numpy.full(len(grams), numpy.nan)
+        backoff = numpy.zeros(len(grams))
+        for k in range(self.n_size, 0, -1):
+            suffix = grams[:, self.n_size - k:]
+            found = lookup_counts(log_probs[k - 1], pack_kgrams(suffix, bits), numpy.nan)
+            hit = numpy.isnan(result) & ~numpy.isnan(found)
+            result[hit] = backoff[hit] + found[hit]
+            if k > 1:
+                # Vrstice, ki so ze najdene, utezi sestopa ne potrebujejo vec
+                backoff += lookup_counts(backoffs[k - 2], pack_kgrams(suffix[:, :-1], bits))
+        missing = numpy.isnan(result)
+        result[missing] = backoff[missing] + self.unknown_log_prob()
+        return result
+
+    @stats.timed('kneser_ney.score_sentences')
+    def score_sentences(self, sentences, d=0.75):
+        """
+        Oceni vec povedi naenkrat. Vse n-grame pretvori v id-je in logaritme verjetnosti (iz koncnih
+        tabel, ce je model dokoncan, glej finalize) izracuna vektorsko z NumPy.
+
+        :param sentences zaporedje povedi
+        :returns tabeli logaritmov verjetnosti in perpleksnosti povedi
+        """
+        vocabulary, tables = self.compiled_tables()
+        unknown = len(vocabulary)   # id, ki ni v besednjaku, zato se ne ujema z nobenim kljucem
+        ids = {}
+        word_ids, owners, word_counts = [], [], []
+        for i, sentence in enumerate(sentences):
+            for word in ('<s> ' + sentence.rstrip() + ' </s>').split():
+                if word not in ids:
+                    word_id = vocabulary.index(word)
+                    ids[word] = unknown if word_id is None else word_id
+                word_ids.append(ids[word])
+                owners.append(i)
+            word_counts.append(len(sentence.split(' ')))
+        if not word_counts:
+            return numpy.zeros(0), numpy.zeros(0)
+        stats.count('kneser_ney.sentences', len(word_counts))
+
+        # Vsa okna dolzine n, ki ne prekoracijo meje povedi
+        word_ids = numpy.array(word_ids, dtype=numpy.uint64)
+        owners = numpy.array(owners)
+        if len(word_ids) >= self.n_size:
+            windows = numpy.lib.stride_tricks.sliding_window_view(word_ids, self.n_size)
+            valid = owners[:len(windows)] == owners[self.n_size - 1:]
+            if self.log_probs is not None:
+                log_probs = self.backoff_log_vector(windows[valid], tables) * math.log(10)
+            else:
+                log_probs = numpy.log(self.kn_prob_vector(windows[valid], tables, d))
+            stats.count('kneser_ney.ngrams', len(log_probs))
+            sentence_log = numpy.bincount(owners[:len(windows)][valid], weights=log_probs,
+                                          minlength=len(word_counts))
+        else:
+            sentence_log = numpy.zeros(len(word_counts))
+        return sentence_log, numpy.exp(-sentence_log / numpy.array(word_counts))
+
     def sentence_perplexity(self, sentence):
         """ Izracuna perpleksnost ene povedi """
         words = len(sentence.split(' '))
-        kn_score = self.kn_evaluate_sentence(sentence)
-        return kn_score ** (-1.0 / words)
+        return math.exp(self.kn_log_evaluate_sentence(sentence) * (-1.0 / words))
 
-    def file_perplexity(self, filename):
-        """  Izracuna povprecno perpleksnost povedi v datoteki """
-        perplexes = []
+    @stats.timed('kneser_ney.file_perplexity')
+    def file_perplexity(self, filename, batch_size=10000):
+        """  Izracuna povprecno perpleksnost povedi v datoteki (povedi ocenjuje v paketih po batch_size) """
+        log_sum = 0
         print('Calculating file perplexity ...', end=' ')
         start = timer()
         file_len = 0;
+        batch = []
         with open(filename) as file:
             for sentence in self.get_sentences(file):
                 if len(sentence.split(' ')) < 1:
                     continue
                 file_len += 1
-                perplexes.append(math.log(self.kn_evaluate_sentence(sentence)))
+                batch.append(sentence)
+                if len(batch) == batch_size:
+                    log_sum += self.score_sentences(batch)[0].sum()
+                    batch = []
+        if batch:
+            log_sum += self.score_sentences(batch)[0].sum()
         print(' %.2fs' % (timer() - start))
-        return math.pow(10, (sum(perplexes) * -1.0 / file_len))
+        return math.pow(10, (log_sum * -1.0 / file_len))
@@ -1,4 +1,490 @@
+#!/usr/bin/env python3
+#
+# Segmentacija diplomskih del korpusa KAS (glej ../README.md in ../rules.md).
+# Dokument se bere sproti (iterparse), obdelane strani se brisejo iz pomnilnika,
+# rezultati pa se sproti pisejo v datoteko .res
+#
+# Segmentacija ima dva koraka: izlocanje znacilk odstavkov (vsa pravila so zdruzena v en regularni izraz)
+# in odlocanje (Segmenter), ki iz znacilk doloci razrede. Znacilke se lahko shranijo v stolpcno
+# shrambo na disku (FeatureStore), zato po spremembi odlocanja dokumentov ni treba ponovno brati.
+#
+import os
+import re
+import sys
+import time
+import numpy
+import shutil
+import hashlib
+import zipfile
+import argparse
+import tempfile
 import xml.etree.ElementTree as ET
+from multiprocessing import Pool
+from collections import Counter
+from pathlib import Path
+try:
+    from instrument import stats
+except ImportError:
+    # Skupna instrumentacija je v korenu repozitorija (../../instrument.py)
+    sys.path.append(str(Path(__file__).resolve().parents[2]))
+    from instrument import stats
+
+# Atributa xml:id in xml:lang
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+# Razdelki dokumenta (front, body, back), ki jim pripadajo strani
+REGIONS = ('front', 'body', 'back')
+
+# Razredi odstavkov, front in back sta odstavka na zacetnih oziroma koncnih straneh, ki ne spadata drugam
+PARAGRAPH_CLASSES = ('titlePage', 'front', 'toc', 'toa', 'abstractSlo', 'abstractEn', 'abstractDe',
+                     'introduction', 'chapter', 'conclusion', 'bibliography', 'back')
+
+# Naslovi razdelkov (brez zaporedne stevilke) -> razred odstavkov, ki sledijo naslovu
+SECTION_TITLES = [
+    (r'((SEZNAM|KAZALO)\s+(UPORABLJENIH\s+)?)?(KRATIC|OKRAJŠAV|SIMBOLOV)|(KRATICE|OKRAJŠAVE)\b', 'toa'),
+    (r'(KAZALO|VSEBINA)\b', 'toc'),
+    (r'(POVZETEK|IZVLEČEK)\b', 'abstractSlo'),
+    (r'(ABSTRACT|SUMMARY)\b', 'abstractEn'),
+    (r'(ZUSAMMENFASSUNG|KURZFASSUNG)\b', 'abstractDe'),
+    (r'UVOD\b', 'introduction'),
+    (r'(ZAKLJUČ[A-ZČŠŽ]*|SKLEP[A-ZČŠŽ]*)\b', 'conclusion'),
+    (r'(LITERATURA|BIBLIOGRAFIJA|((UPORABLJENI|SEZNAM)\s+)?(VIRI|VIROV|LITERATURE)(\s+IN\s+(LITERATURA|VIRI))?)\b',
+     'bibliography'),
+    (r'(SEZNAM\s+(SLIK|TABEL|GRAFOV|PRILOG)|PRILOG[AE])\b', 'back'),
+    (r'(PREDGOVOR|ZAHVALA|IZJAVA)\b', 'front'),
+]
+# Pravila za znacilke odstavkov (ime znacilke -> regularni izraz, ki se mora ujemati na zacetku odstavka)
+RULES = [
+    # Naslov s stevilko poglavja, npr. '2 RAZVOJ', '2. Razvoj' ali '2.1 Pojmi'
+    ('numbered', r'(?P<number>\d{1,2})(?P<subsection>(?:\.\d{1,2})*)\.?\s+\S'),
+    # Naslov razdelka, lahko s stevilko poglavja (glej SECTION_TITLES)
+    ('title', r'(?:\d{1,2}(?:\.\d{1,2})*\.?\s+)?(?:%s)' % '|'.join(
+        '(?P<title_%s>%s)' % (cls, pattern) for pattern, cls in SECTION_TITLES)),
+    # Vrstica, ki se konca s stevilko strani, npr. '1 UVOD 1' (pike kazala preverja TOC_DOTS)
+    ('toc_page', r'.*\s[0-9IVXLC]{1,4}\s*$'),
+    # Kljucne besede, vsebina je za dvopicjem ali v naslednjem odstavku
+    ('keywords', r'(?:KLJUČNE\s+BESEDE|KEY\s*WORDS|SCHLÜSSELWÖRTER)\s*:?\s*'),
+    # Podatki, ki se pojavijo na naslovni strani (besede preverjamo le pri zacetnih crkah D, F, M in U)
+    ('title_page', r'(?=(?P<title_text>[^dfmu]*(?:(?!{0})[dfmu][^dfmu]*)*))(?P=title_text)(?:{0})'.format(
+        'UNIVERZA|FAKULTETA|MENTOR|DIPLOMSK|MAGISTRSK|DOKTORSK')),
+    # Enota literature, npr. '[1] Burian, Dušan. 1999.' ali 'Burian, D. (1999)'
+    ('reference', r'\[\d+\]\s|\d{1,3}\.\s+[A-ZČŠŽ][\w-]+,\s|[A-ZČŠŽ][\w-]+,\s+[A-ZČŠŽ][\w.-]*.{0,80}?\(?(?:19|20)\d\d'),
+    # Opis kratice, npr. 'EU – Evropska unija'
+    ('acronym', r'(?-i:[A-ZČŠŽ]{2,}[A-Za-zČŠŽčšž0-9]*)\s*[–—-]\s+\S'),
+    # Opis slike ali tabele, npr. 'TABELA 3: DINAMIKA ...'
+    ('caption', r'(?:SLIKA|SLIKE|TABELA|TABELE|GRAF|GRAFIKON|SHEMA|PREGLEDNICA|DIAGRAM|FIGURE|TABLE)\s*\d+'),
+]
+# Vsa pravila v enem regularnem izrazu, vsako pravilo je neobvezen pogled naprej z imenovano skupino
+FEATURE_MATCHER = re.compile(''.join('(?=(?P<%s>%s))?' % rule for rule in RULES), re.I)
+# Vrstica kazala s pikami, npr. '1 UVOD.......1'. Iscemo jo le v zadnjih TOC_TAIL znakih odstavka, saj bi
+# neuspelo iskanje pik v dolgem odstavku (npr. celotno kazalo v enem odstavku) vracalo cez celotno besedilo
+TOC_DOTS = re.compile(r'(?:(?:\.\s?){4,}|…+)\s*[0-9IVXLC]*\s*$', re.I)
+TOC_TAIL = 120
+# Oznaka pravil, znacilke v shrambi veljajo le za enaka pravila
+RULES_HASH = hashlib.sha1((FEATURE_MATCHER.pattern + TOC_DOTS.pattern).encode('utf-8')).hexdigest()[:16]
+# Besedilo odstavka hranimo le za kratke odstavke (naslove) in tiste, ki jih potrebujemo za povzetek dokumenta
+TEXT_LIMIT = 200
+# Najdaljsi odstavek, ki ga se stejemo za naslov
+MAX_TITLE = 100
+
+# Stolpci tabele znacilk odstavkov in tabele strani (ime -> numpy dtype)
+FEATURE_COLUMNS = {
+    'id': str, 'lang': str, 'text': str, 'page': numpy.int32, 'position': numpy.int32, 'length': numpy.int32,
+    'number': numpy.int8, 'subsection': bool, 'title': numpy.int8, 'ends_punct': bool, 'toc_dots': bool,
+    'toc_page': bool, 'keywords': numpy.int16, 'title_page': bool, 'reference': bool, 'acronym': bool,
+    'caption': bool,
+}
+PAGE_COLUMNS = {'page_id': str, 'page_n': numpy.int32, 'page_size': numpy.int32}
+
+# Razredi odstavkov, ki na koncu dokumenta pomenijo koncne strani (back)
+BACK_SECTIONS = {'abstractSlo', 'abstractEn', 'abstractDe', 'toa', 'bibliography', 'back'}
+# Jeziki povzetkov glede na xml:lang
+ABSTRACT_LANGS = {'sl': 'abstractSlo', 'en': 'abstractEn', 'de': 'abstractDe'}
+
+
+def string_column(values):
+    """ Zapise seznam nizov kot en niz bajtov (utf-8) in tabelo zacetkov nizov """
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8), offsets
+
+
+def read_strings(data, offsets):
+    """ Vrne seznam nizov iz zapisa string_column """
+    data = data.tobytes()
+    offsets = offsets.tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def paragraph_features(paragraph_id, lang, text, page, position, after_keywords=False):
+    """
+    Izracuna znacilke odstavka z enim ujemanjem zdruzenih pravil
+
+    :param paragraph_id: xml:id odstavka
+    :param lang: xml:lang odstavka
+    :param text: besedilo odstavka
+    :param page: zaporedna stevilka strani
+    :param position: zaporedna stevilka odstavka na strani
+    :param after_keywords: ali je prejsnji odstavek naslov kljucnih besed (besedilo odstavka se ohrani)
+    :return: slovar znacilk (glej FEATURE_COLUMNS)
+    """
+    text = ' '.join(text.split())
+    match = FEATURE_MATCHER.match(text)
+    groups = match.groupdict()
+    title = next((i for i, (_, cls) in enumerate(SECTION_TITLES) if groups['title_' + cls]), -1)
+    features = {
+        'id': paragraph_id, 'lang': lang or '', 'page': page, 'position': position, 'length': len(text),
+        'number': int(groups['number']) if groups['numbered'] else 0, 'subsection': bool(groups['subsection']),
+        'title': title, 'ends_punct': text.endswith(('.', ',', ';', ':', '?', '!')),
+        'toc_dots': TOC_DOTS.search(text[-TOC_TAIL:]) is not None, 'toc_page': groups['toc_page'] is not None,
+        # Zacetek vsebine kljucnih besed v besedilu ali -1
+        'keywords': match.end('keywords') if groups['keywords'] is not None else -1,
+        'title_page': groups['title_page'] is not None, 'reference': groups['reference'] is not None,
+        'acronym': groups['acronym'] is not None, 'caption': groups['caption'] is not None,
+    }
+    keep = (len(text) <= TEXT_LIMIT or after_keywords or features['keywords'] >= 0 or features['reference'] or
+            features['acronym'] or features['caption'])
+    features['text'] = text if keep else ''
+    return features
+
+
+def extract_features(source):
+    """
+    Sproti bere dokument in izracuna znacilke odstavkov, obdelane strani pobrise iz pomnilnika
+
+    :param source: ime datoteke ali odprta (binarna) datoteka
+    :return: generator trojic (xml:id strani, stevilka strani, seznam znacilk odstavkov na strani)
+    """
+    context = ET.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    page_id, page_number, rows = None, 0, []
+    after_keywords = False
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag == 'page':
+                page_id, rows = elem.get(XML_ID), []
+                page_number = int(elem.get('n', page_number + 1))
+            continue
+        if elem.tag == 'p':
+            row = paragraph_features(elem.get(XML_ID), elem.get(XML_LANG), ''.join(elem.itertext()),
+                                     page_number, len(rows), after_keywords)
+            after_keywords = row['keywords'] == row['length']
+            rows.append(row)
+            elem.clear()
+        elif elem.tag == 'page':
+            yield page_id, page_number, rows
+            # Stran je obdelana, odstrani jo iz drevesa
+            root.clear()
+
+
+class FeatureStore:
+    """ Stolpcna shramba znacilk odstavkov na disku, ena datoteka .npz na dokument """
+
+    def __init__(self, directory='features'):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, doc_id):
+        """ Vrne pot do datoteke z znacilkami dokumenta """
+        return self.directory / (doc_id + '.npz')
+
+    def load(self, doc_id, fingerprint):
+        """
+        Prebere znacilke dokumenta, ce so izracunane z enakimi pravili iz enake datoteke
+
+        :param doc_id: oznaka dokumenta
+        :param fingerprint: oznaka vsebine dokumenta (glej fingerprint)
+        :return: generator strani (glej extract_features) ali None
+        """
+        path = self.path(doc_id)
+        if not path.is_file():
+            return None
+        with numpy.load(path) as data:
+            if data['meta'].tolist() != [RULES_HASH, fingerprint]:
+                return None
+            columns = {}
+            for name, dtype in list(FEATURE_COLUMNS.items()) + list(PAGE_COLUMNS.items()):
+                if dtype is str:
+                    columns[name] = read_strings(data[name + '_data'], data[name + '_offsets'])
+                else:
+                    columns[name] = data[name].tolist()
+        return self.pages(columns)
+
+    @staticmethod
+    def pages(columns):
+        """ Razdeli stolpce znacilk nazaj po straneh """
+        names = list(FEATURE_COLUMNS)
+        rows = (dict(zip(names, values)) for values in zip(*(columns[name] for name in names)))
+        for page_id, page_n, size in zip(columns['page_id'], columns['page_n'], columns['page_size']):
+            yield page_id, page_n, [next(rows) for _ in range(size)]
+
+    @stats.timed('segment.save_features')
+    def save(self, doc_id, fingerprint, pages):
+        """ Zapise znacilke strani (seznam, glej extract_features) v stolpcni obliki """
+        rows = [row for _, _, page_rows in pages for row in page_rows]
+        values = {name: [row[name] for row in rows] for name in FEATURE_COLUMNS}
+        values['page_id'] = [page_id or '' for page_id, _, _ in pages]
+        values['page_n'] = [page_n for _, page_n, _ in pages]
+        values['page_size'] = [len(page_rows) for _, _, page_rows in pages]
+        columns = {'meta': numpy.array([RULES_HASH, fingerprint])}
+        for name, dtype in list(FEATURE_COLUMNS.items()) + list(PAGE_COLUMNS.items()):
+            # Nizi so zapisani kot en niz bajtov in tabela zacetkov (glej string_column)
+            if dtype is str:
+                columns[name + '_data'], columns[name + '_offsets'] = string_column(values[name])
+            else:
+                columns[name] = numpy.array(values[name], dtype=dtype)
+        # Vec procesov lahko pise hkrati, zato najprej pisemo v zacasno datoteko
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            numpy.savez(f, **columns)
+        os.replace(tmp, self.path(doc_id))
+
+
+def fingerprint(filename):
+    """ Vrne oznako vsebine datoteke (velikost in cas spremembe) """
+    stat = os.stat(filename)
+    return '%d-%d' % (stat.st_size, stat.st_mtime_ns)
+
+
+class Segmenter:
+    """ Razvrsca odstavke enega dokumenta po vrsti, kot se pojavijo v datoteki (korak odlocanja) """
+
+    def __init__(self):
+        # Razred trenutnega razdelka in razdelek dokumenta (front, body, back)
+        self.section = None
+        self.region = 'front'
+        # Zaporedna stevilka zadnjega poglavja
+        self.chapter = 0
+        # Ali naslednji odstavek vsebuje kljucne besede
+        self.expect_keywords = False
+        # Naslovi poglavij [(id, naslov)], kljucne besede, kratice, slike in literatura, ki jih izpisemo na koncu .res
+        self.chapters = []
+        self.keywords = []
+        self.acronyms = []
+        self.captions = []
+        self.references = []
+
+    @stats.timed('segment.classify')
+    def classify(self, row):
+        """
+        Vrne razred odstavka in posodobi stanje dokumenta
+
+        :param row: znacilke odstavka (glej paragraph_features)
+        :return: razred odstavka (glej PARAGRAPH_CLASSES)
+        """
+        cls = self.decide(row)
+        if row['acronym'] and cls == 'toa':
+            self.acronyms.append(row['text'])
+        elif row['caption'] and cls not in ('toc', 'toa', 'back'):
+            self.captions.append(row['text'])
+        elif row['reference'] and cls == 'bibliography':
+            self.references.append(row['text'])
+        return cls
+
+    def decide(self, row):
+        """ Doloci razred odstavka iz znacilk (glej classify) """
+        text, length = row['text'], row['length']
+        if self.expect_keywords:
+            self.expect_keywords = False
+            self.keywords.append(text)
+            return self.section
+        if row['keywords'] >= 0 and self.section in ABSTRACT_LANGS.values():
+            if row['keywords'] < length:
+                self.keywords.append(text[row['keywords']:])
+            else:
+                self.expect_keywords = True
+            return self.section
+
+        if row['toc_dots'] and self.region == 'front':
+            # Kazalo brez naslova se zacne s prvo vrstico s pikami
+            self.section = 'toc'
+            return 'toc'
+        if self.section == 'toc':
+            if length <= MAX_TITLE and row['toc_page']:
+                return 'toc'
+            if length > MAX_TITLE:
+                # Daljse besedilo pomeni konec kazala
+                self.section = 'front' if self.region == 'front' else 'chapter'
+        title = None
+        if row['title'] >= 0 and length <= MAX_TITLE and not row['ends_punct']:
+            title = SECTION_TITLES[row['title']][1]
+        if (row['number'] and length <= MAX_TITLE and not row['ends_punct']
+                and row['number'] == self.chapter + 1):
+            # Naslednje poglavje, razred doloca naslov (privzeto navadno poglavje). Ce naslov poglavja manjka,
+            # ga zacne ze prvo podpoglavje, prvo poglavje je v tem primeru uvod
+            self.chapter += 1
+            if row['subsection']:
+                self.start_section('introduction' if self.chapter == 1 else 'chapter')
+            else:
+                self.start_section(title or 'chapter')
+            self.chapters.append((row['id'], text))
+        elif title is not None and not row['number']:
+            self.start_section(title)
+        elif self.section is None:
+            self.section = 'titlePage' if row['page'] == 1 or row['title_page'] else 'front'
+        elif self.section == 'titlePage' and not row['title_page'] and row['page'] > 1:
+            self.section = 'front'
+
+        if self.section in ABSTRACT_LANGS.values():
+            # Povzetki v tujem jeziku brez svojega naslova
+            return ABSTRACT_LANGS.get(row['lang'], self.section)
+        return self.section
+
+    def start_section(self, cls):
+        """ Zacne nov razdelek razreda cls in po potrebi preide v naslednji razdelek dokumenta """
+        self.section = cls
+        if cls in ('introduction', 'chapter', 'conclusion'):
+            if self.region == 'front':
+                self.region = 'body'
+        elif cls in BACK_SECTIONS and self.region == 'body':
+            self.region = 'back'
+
+    def write_summary(self, out):
+        """ Izpise seznam poglavij, kljucne besede, kratice, slike in tabele ter literaturo """
+        for paragraph_id, title in self.chapters:
+            out.write('%s: chapter %s\n' % (paragraph_id, title))
+        if self.keywords:
+            out.write('\nkeywords: %s\n' % ', '.join(self.keywords))
+        for name, lines in (('acronyms', self.acronyms), ('figures', self.captions),
+                            ('bibliography', self.references)):
+            if lines:
+                out.write('\n%s:\n\n%s\n' % (name, '\n'.join(lines)))
+
+
+@stats.timed('segment.document')
+def segment(source, out, store=None, doc_id=None, doc_fingerprint=None):
+    """
+    Segmentira dokument in sproti pise rezultate v obliki .res (glej ../README.md)
+
+    :param source: ime datoteke ali odprta (binarna) datoteka
+    :param out: odprta datoteka za rezultate
+    :param store: shramba znacilk (FeatureStore) ali None
+    :param doc_id: oznaka dokumenta v shrambi (privzeto ime datoteke do prve pike)
+    :param doc_fingerprint: oznaka vsebine dokumenta (privzeto velikost in cas spremembe datoteke)
+    :return: Counter s stevilom odstavkov posameznega razreda in strani posameznega razdelka (npr. front_pages)
+    """
+    pages = None
+    if store is not None:
+        doc_id = doc_id or Path(source).name.split('.')[0]
+        doc_fingerprint = doc_fingerprint or fingerprint(source)
+        pages = store.load(doc_id, doc_fingerprint)
+    stats.count('segment.cached_documents' if pages is not None else 'segment.extracted_documents')
+    # Ce znacilk ni v shrambi, jih izracunamo in shranimo
+    extracted = [] if store is not None and pages is None else None
+    if pages is None:
+        pages = extract_features(source)
+
+    segmenter = Segmenter()
+    counts = Counter()
+    out.write('ID CLASS\n')
+    # Razdelke strani izpisemo za odstavki, zato jih hranimo v zacasni datoteki
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as page_lines:
+        # Cas branja strani je cas izlocanja znacilk (ali branja iz shrambe)
+        for page_id, page_number, rows in stats.timed_iter('segment.page_features', pages):
+            page_region = None
+            for row in rows:
+                cls = segmenter.classify(row)
+                out.write('%s %s\n' % (row['id'], cls))
+                counts[cls] += 1
+                # Stran pripada razdelku, v katerem je njen prvi odstavek
+                page_region = page_region or segmenter.region
+            page_region = page_region or segmenter.region
+            page_lines.write('%s %s\n' % (page_id, page_region))
+            counts[page_region + '_pages'] += 1
+            if extracted is not None:
+                extracted.append((page_id, page_number, rows))
+        out.write('\n')
+        page_lines.seek(0)
+        shutil.copyfileobj(page_lines, out)
+    out.write('\n')
+    segmenter.write_summary(out)
+    if extracted is not None:
+        store.save(doc_id, doc_fingerprint, extracted)
+    return counts
+
+
+def result_name(filename, output_dir=None):
+    """ Vrne ime datoteke .res za dokument, npr. kas-4000.text.xml -> kas-4000.res """
+    path = Path(filename)
+    name = path.name.split('.')[0] + '.res'
+    return Path(output_dir) / name if output_dir else path.with_name(name)
+
+
+# Arhiv, direktorij za rezultate in shramba znacilk v procesu iz bazena (glej segment_corpus)
+worker_archive = None
+worker_output = None
+worker_store = None
+
+
+def init_worker(archive, output_dir, features):
+    """ Odpre arhiv in shrambo znacilk v procesu iz bazena (vsak proces ima svoj odprt arhiv) """
+    global worker_archive, worker_output, worker_store
+    worker_archive = zipfile.ZipFile(archive) if archive else None
+    worker_output = output_dir
+    worker_store = FeatureStore(features) if features else None
+
+
+def segment_in_worker(document):
+    """
+    Segmentira en dokument (datoteko ali clan arhiva) v procesu iz bazena
+
+    :return: trojica (dokument, Counter razredov, cas v sekundah)
+    """
+    start = time.perf_counter()
+    with open(result_name(document, worker_output), 'w', encoding='utf-8') as out:
+        if worker_archive is None:
+            counts = segment(document, out, worker_store)
+        else:
+            # Clan arhiva beremo kot tok, brez razsirjanja na disk, oznaka vsebine je velikost in CRC
+            info = worker_archive.getinfo(document)
+            with worker_archive.open(info) as source:
+                counts = segment(source, out, worker_store, Path(document).name.split('.')[0],
+                                 '%d-%08x' % (info.file_size, info.CRC))
+    return document, counts, time.perf_counter() - start
+
+
+def archive_documents(archive):
+    """ Vrne imena dokumentov xml v arhivu zip """
+    with zipfile.ZipFile(archive) as z:
+        return [name for name in z.namelist() if name.endswith('.xml')]
+
+
+def segment_corpus(documents, output_dir, archive=None, processes=1, features=None):
+    """
+    Segmentira vec dokumentov v bazenu procesov in zapise povzetek za celoten korpus
+
+    :param documents: imena datotek ali clanov arhiva
+    :param output_dir: direktorij za datoteke .res in povzetek (summary.txt)
+    :param archive: arhiv zip, iz katerega beremo dokumente, ali None
+    :param processes: stevilo procesov v bazenu (None uporabi vsa jedra)
+    :param features: direktorij s shrambo znacilk ali None
+    :return: generator trojic (dokument, Counter razredov, cas v sekundah) v vrstnem redu dokumentov
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    columns = PARAGRAPH_CLASSES + tuple(region + '_pages' for region in REGIONS)
+    total, total_time = Counter(), 0.0
+    pool = None if processes == 1 else Pool(processes, initializer=init_worker,
+                                             initargs=(archive, output_dir, features))
+    try:
+        if pool is None:
+            init_worker(archive, output_dir, features)
+            results = map(segment_in_worker, documents)
+        else:
+            results = pool.imap(segment_in_worker, documents)
+        with open(Path(output_dir) / 'summary.txt', 'w', encoding='utf-8') as summary:
+            summary.write('DOCUMENT SECONDS %s\n' % ' '.join(columns))
+            for document, counts, seconds in results:
+                summary.write('%s %.3f %s\n' % (Path(document).name.split('.')[0], seconds,
+                                                 ' '.join(str(counts[c]) for c in columns)))
+                total.update(counts)
+                total_time += seconds
+                yield document, counts, seconds
+            summary.write('TOTAL %.3f %s\n' % (total_time, ' '.join(str(total[c]) for c in columns)))
+    finally:
+        if pool is not None:
+            pool.terminate()
 
 
 def main():
@@ -6,16 +492,40 @@ def main():
     Glavna funkcija, ki prozi zacetek segmentacije
     :return: NULL
     """
-    document = ET.parse("kas-4000.text.xml")
-    root = document.getroot()
-
-    pages = [page for page in root.findall('./page')]
+    parser = argparse.ArgumentParser(description='Segmentacija dokumentov korpusa KAS.')
+    parser.add_argument('documents', nargs='*', help='datoteke xml ali clani arhiva (privzeto kas-4000.text.xml '
+                                                     'oziroma vsi dokumenti v arhivu)')
+    parser.add_argument('-o', '--output-dir', help='direktorij za datoteke .res (privzeto poleg dokumenta, '
+                                                   'pri arhivu rezultati)')
+    parser.add_argument('-f', '--features', metavar='DIR',
+                        help='direktorij s shrambo znacilk, ob ponovnem zagonu se dokumenti ne berejo znova')
+    parser.add_argument('-z', '--zip', metavar='ARCHIVE', help='beri dokumente iz arhiva zip, npr. ../korpus.zip')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='stevilo procesov (0 uporabi vsa jedra)')
+    parser.add_argument('-s', '--stats', metavar='FILE',
+                        help='zapisi case in stevce glavnega procesa v FILE (JSON, s koncnico .prof profil cProfile)')
+    args = parser.parse_args()
+    if args.stats:
+        stats.configure(args.stats)
 
-    for page in pages:
-        print('\nNova stran')
-        for elem in page.iter('p'):
+    if args.zip or args.processes != 1:
+        # Paketna obdelava, en .res na dokument in povzetek summary.txt
+        documents = args.documents or (archive_documents(args.zip) if args.zip else ['kas-4000.text.xml'])
+        output_dir = args.output_dir or ('rezultati' if args.zip else '.')
+        start = time.perf_counter()
+        for document, counts, seconds in segment_corpus(documents, output_dir, args.zip, args.processes or None,
+                                                         args.features):
+            print('%s: %.3fs %s' % (document, seconds, ', '.join('%s=%d' % item for item in sorted(counts.items()))),
+                  file=sys.stderr)
+        print('%d documents in %.3fs' % (len(documents), time.perf_counter() - start), file=sys.stderr)
+        return
 
-            print(elem)
+    if args.output_dir:
+        Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    store = FeatureStore(args.features) if args.features else None
+    for document in args.documents or ['kas-4000.text.xml']:
+        with open(result_name(document, args.output_dir), 'w', encoding='utf-8') as out:
+            counts = segment(document, out, store)
+        print('%s: %s' % (document, ', '.join('%s=%d' % item for item in sorted(counts.items()))), file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -12,12 +12,31 @@
 #
 # @author David Rubin
 # @license MIT
+import os
 import re
+import sys
+import json
 import math
+import heapq
+import numpy
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+from contextlib import contextmanager
+from itertools import islice
+from pathlib import Path
+from timeit import default_timer as timer
 from bs4 import BeautifulSoup
 from collections import defaultdict
 from string import punctuation
 from kneser_ney import LanguageModel
+try:
+    from instrument import stats
+except ImportError:
+    # The shared instrumentation is in the root of the repository (../instrument.py)
+    sys.path.append(str(Path(__file__).resolve().parents[1]))
+    from instrument import stats
 
 
 def compare_words(file1, file2='actual.dat'):
@@ -41,14 +60,38 @@ def preprocess_file(filename):
         return preprocess_string(data)
 
 
+def file_hash(filename):
+    """ Returns the sha256 hash of the file contents """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@contextmanager
+def replaced_file(filename, mode='w'):
+    """
+    Opens a temporary file next to filename and replaces filename with it once it is written,
+    so other processes never read a partially written file
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as f:
+            yield f
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 def preprocess_string(some_string):
     """ Remove punctuation/numbers, to lower case """
     return some_string.lower().replace("\n", " ").replace("\r", "").translate(str.maketrans('', '', punctuation))
 
 
-def words_at_distance1(word):
+def words_at_distance1(word, letters='abcdefghijklmnopqrstuvwxyz'):
     """ Return all words that are at (levenshtein) distance 1"""
-    letters = 'abcdefghijklmnopqrstuvwxyz'
     splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
     deletions = [L + R[1:] for L, R in splits if R]
     transpositions = [L + R[1] + R[0] + R[2:] for L, R in splits if len(R) > 1]
@@ -65,30 +108,189 @@ def words_at_distance2(word):
     return set(words2 for words1 in words_at_distance1(word) for words2 in words_at_distance1(words1))
 
 
+def deletes(word, max_distance):
+    """ Returns all strings made by deleting up to max_distance characters from the word """
+    result = {word}
+    edges = {word}
+    for _ in range(max_distance):
+        edges = {w[:i] + w[i + 1:] for w in edges for i in range(len(w))}
+        result |= edges
+    return result
+
+
+def delete_hash(delete):
+    """ Returns a 64-bit hash of the string that is the same in every process (unlike hash()) """
+    return int.from_bytes(hashlib.blake2b(delete.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def edit_distance(a, b, limit):
+    """
+    Damerau-levenshtein distance (deletions, insertions, replaces and transpositions as in
+    words_at_distance1), returns limit + 1 if the lengths alone already exceed the limit
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    infinity = len(a) + len(b)
+    d = [[infinity] * (len(b) + 2)] + [[infinity] + list(range(len(b) + 1))]
+    d += [[infinity, i] + [0] * len(b) for i in range(1, len(a) + 1)]
+    last_row = {}  # The last row in which each character of a was seen
+    for i in range(1, len(a) + 1):
+        last_column = 0  # The last column in this row where the characters matched
+        for j in range(1, len(b) + 1):
+            i1 = last_row.get(b[j - 1], 0)
+            j1 = last_column
+            cost = 1
+            if a[i - 1] == b[j - 1]:
+                cost = 0
+                last_column = j
+            d[i + 1][j + 1] = min(d[i][j] + cost, d[i + 1][j] + 1, d[i][j + 1] + 1,
+                                  d[i1][j1] + (i - i1 - 1) + 1 + (j - j1 - 1))
+        last_row[a[i - 1]] = i
+    return d[len(a) + 1][len(b) + 1]
+
+
+class CandidateIndex:
+    """
+    Symmetric delete (SymSpell) index of the dictionary words. Every string made by deleting up to
+    max_distance characters from a dictionary word points to that word, so the words within a distance
+    are found by looking up the deletes of the query instead of generating every possible edit.
+    The deletes are kept as sorted 64-bit hashes with the ids of their words, so the index is saved
+    and loaded as a few arrays (hash collisions only add candidates, which the edit distance filters out).
+    """
+
+    def __init__(self, words=(), max_distance=2, alphabet=None):
+        self.max_distance = max_distance
+        self.alphabet = alphabet  # Only words made of these letters are indexed (None allows any letter)
+        self.words = sorted(w for w in words if alphabet is None or set(w) <= set(alphabet))
+        hashes, ids = [], []
+        for i, word in enumerate(self.words):
+            for d in deletes(word, max_distance):
+                hashes.append(delete_hash(d))
+                ids.append(i)
+        hashes = numpy.array(hashes, dtype=numpy.uint64)
+        order = numpy.argsort(hashes, kind='stable')
+        self.hashes = hashes[order]
+        self.ids = numpy.array(ids, dtype=numpy.int32)[order]
+
+    def lookup(self, word, distance):
+        """ Returns the dictionary words within the given edit distance of the word """
+        keys = numpy.array([delete_hash(d) for d in deletes(word, distance)], dtype=numpy.uint64)
+        starts = numpy.searchsorted(self.hashes, keys, 'left').tolist()
+        ends = numpy.searchsorted(self.hashes, keys, 'right').tolist()
+        found = set()
+        for start, end in zip(starts, ends):
+            for i in self.ids[start:end].tolist():
+                candidate = self.words[i]
+                if candidate not in found and edit_distance(word, candidate, distance) <= distance:
+                    found.add(candidate)
+        return found
+
+    def save(self, filename):
+        """ Saves the index into a numpy .npz file (the words are one utf-8 string with offsets) """
+        encoded = [word.encode('utf-8') for word in self.words]
+        with replaced_file(filename, 'wb') as f:
+            numpy.savez(f, max_distance=self.max_distance, alphabet=self.alphabet or '',
+                        words=numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8),
+                        offsets=numpy.cumsum([0] + [len(word) for word in encoded], dtype=numpy.int64),
+                        hashes=self.hashes, ids=self.ids)
+
+    @classmethod
+    def load(cls, filename):
+        """ Reads the index saved with save """
+        with numpy.load(filename) as data:
+            index = cls(max_distance=int(data['max_distance']), alphabet=str(data['alphabet']) or None)
+            # The offsets are in bytes, so split the bytes before decoding the words
+            blob, offsets = data['words'].tobytes(), data['offsets'].tolist()
+            index.words = [blob[a:b].decode('utf-8') for a, b in zip(offsets, offsets[1:])]
+            index.hashes = data['hashes']
+            index.ids = data['ids']
+        return index
+
+
 class SpellCheck:
-    def __init__(self, learn_corpus='corpus/big.txt'):
-        self.model = defaultdict(int)  # The dictionary with word frequencies
+    def __init__(self, learn_corpus='corpus/big.txt', index_file='candidates.npz', alphabet=None,
+                 model_file='big_model.lm', frequency_file='frequencies.json'):
         self.learn_file = learn_corpus  # The file with the learning set
         self.regex = re.compile(r'[0-9%s^(\s)]' % re.escape(punctuation))
-
-        self.build_model()
-        self.kn = LanguageModel()
-        self.kn.read_from_file('big_model.lm')
+        self.index_file = index_file  # The file with the persisted candidate index
+        self.alphabet = alphabet  # The letters of the indexed words (None allows any letter)
+        self.model_file = model_file  # The Kneser-Ney language model
+        self.frequency_file = frequency_file  # The persisted word frequencies of the learning set
+
+        # The models are loaded on first use (see the properties below)
+        self.frequencies = None
+        self.candidate_index = None
+        self.language_model = None
         #self.kn.train(folder='corpus/')
         #self.kn.save_to_file("big_model.lm")
-        self.V_len = len(self.model.values())
+
+    @property
+    def model(self):
+        """ The dictionary with word frequencies """
+        if self.frequencies is None:
+            self.build_model()
+        return self.frequencies
+
+    @property
+    def index(self):
+        """ The candidate index of the dictionary words """
+        if self.candidate_index is None:
+            self.build_index()
+        return self.candidate_index
+
+    @property
+    def kn(self):
+        """ The Kneser-Ney language model """
+        if self.language_model is None:
+            self.language_model = LanguageModel()
+            self.language_model.read_from_file(self.model_file)
+        return self.language_model
+
+    @property
+    def V_len(self):
+        """ The number of words in the dictionary """
+        return len(self.model)
 
     def build_model(self):
-        """ Counts the frequencies of the word in the given corpus"""
-        corpus = preprocess_file(self.learn_file)
-        for word in corpus.split():
-            # Go through every word in the corpus and increase its frequency
-            self.model[word] += 1
+        """
+        Counts the frequencies of the word in the given corpus. The frequencies are saved with the
+        hash of the corpus into frequency_file and only counted again when the corpus changes.
+        """
+        corpus_hash = file_hash(self.learn_file)
+        if self.frequency_file and Path(self.frequency_file).is_file():
+            with open(self.frequency_file, encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved['hash'] == corpus_hash:
+                self.frequencies = defaultdict(int, saved['model'])
+                return
+
+        self.frequencies = defaultdict(int)
+        with open(self.learn_file) as f:
+            for line in f:
+                for word in preprocess_string(line).split():
+                    # Go through every word in the corpus and increase its frequency
+                    self.frequencies[word] += 1
+        if self.frequency_file:
+            with replaced_file(self.frequency_file) as f:
+                json.dump({'hash': corpus_hash, 'model': self.frequencies}, f, ensure_ascii=False)
+
+    def build_index(self):
+        """ Reads the candidate index from disk or builds it from the dictionary if it is stale """
+        words = sorted(w for w in self.model if self.alphabet is None or set(w) <= set(self.alphabet))
+        if self.index_file and Path(self.index_file).is_file():
+            index = CandidateIndex.load(self.index_file)
+            if index.alphabet == self.alphabet and index.max_distance >= 2 and index.words == words:
+                self.candidate_index = index
+                return
+        self.candidate_index = CandidateIndex(words, alphabet=self.alphabet)
+        if self.index_file:
+            self.candidate_index.save(self.index_file)
 
     def valid_words(self, words):
         """ Returns the words from the set if they are in the dictionary (model) """
         return set(word for word in words if word in self.model)
 
+    @stats.timed('spellcheck.generate_candidates')
     def generate_candidates(self, word):
         """ Generates all candidates for the given word with probabilities """
         candidates = {}
@@ -100,7 +302,7 @@ class SpellCheck:
 
         # If the given word is not in the dict, calculate the probabilities for words
         # at distance 1. Normalize the frequencies with the sum of given words
-        w1 = self.valid_words(words_at_distance1(word))
+        w1 = self.index.lookup(word, 1)
         if len(w1) > 0:
             freq_sum = 0
             for w in w1:
@@ -111,7 +313,7 @@ class SpellCheck:
             return candidates
 
         # If none of the edit distance 1 are in the dictionary, generate distance 2 words
-        w2 = self.valid_words(words_at_distance2(word))
+        w2 = self.index.lookup(word, 2)
         if len(w2) > 0:
             freq_sum = 0
             for w in w2:
@@ -126,25 +328,114 @@ class SpellCheck:
         candidates[word] = 1
         return candidates
 
-    def check_sentence(self, sentence, mp=1):
-        """ Returns the most probable sentence using Kneser-Ney """
+    @stats.timed('spellcheck.check_sentence')
+    def check_sentence(self, sentence, mp=1, delta=True):
+        """
+        Returns the most probable sentence using Kneser-Ney
+
+        With delta=True the n-gram log probabilities of the sentence are computed once and each
+        candidate only rescores the n-grams that overlap the replaced word.
+        """
+        if not delta:
+            return self.check_sentence_full(sentence, mp)
         sentence = preprocess_string(sentence)
-        evaluations = {}
+        words = sentence.split()
+        padded = ['<s>'] + words + ['</s>']
+        n = self.kn.n_size
+        baseline = self.kn.ngram_log_probs(padded)
+        baseline_sum = sum(baseline)
+
+        # Compare the candidates by the change of the log probability against the unchanged sentence (log(mp)).
+        # Only a strictly better candidate replaces the best one, so ties keep the unchanged sentence and
+        # otherwise the first candidate, the same as in check_sentence_full.
+        best, best_score = None, math.log(mp) if mp > 0 else -math.inf
+        for i in range(0, len(words)):
+            position = i + 1
+            # The n-grams starting at first .. last-1 contain the replaced word
+            first, last = max(0, position - n + 1), min(len(baseline), position + 1)
+            old_sum = sum(baseline[first:last])
+            candidates = self.generate_candidates(words[i])
+            stats.observe('spellcheck.candidates', len(candidates))
+            for word in candidates.keys():
+                word = word.strip()
+                if word == words[i]:
+                    # The same as the unchanged sentence
+                    continue
+                changed = padded[first:position] + [word] + padded[position + 1:last + n - 1]
+                score = sum(self.kn.ngram_log_probs(changed)) - old_sum
+                if score > best_score:
+                    best, best_score = (i, word), score
+
+        if best is None:
+            return sentence
+        i, word = best
+        return ' '.join(words[:i] + [word] + words[i + 1:])
+
+    def check_sentence_full(self, sentence, mp=1):
+        """ Returns the most probable sentence using Kneser-Ney (evaluates every candidate sentence whole) """
+        sentence = preprocess_string(sentence)
+        words = sentence.split()
+        # The unchanged sentence is the first best, only strictly better candidates replace it
+        best = sentence
+        best_score = (math.log(mp) if mp > 0 else -math.inf) + self.kn.kn_log_evaluate_sentence(sentence)
 
         # Calculate the probability if only one word is fixed
-        words = sentence.split()
-        original_multiplier = mp
         for i in range(0, len(words)):
             prefix = ' '.join(words[:i]).lstrip()
             appendix = ' '.join(words[i+1:]).rstrip()
             candidates = self.generate_candidates(words[i])
 
             for word in candidates.keys():
+                if word.strip() == words[i]:
+                    continue
                 candidate_sent = ' '.join([prefix, word.strip(), appendix]).strip()
-                evaluations[candidate_sent] = (self.kn.kn_evaluate_sentence(candidate_sent))
-
-        evaluations[sentence] = original_multiplier * self.kn.kn_evaluate_sentence(sentence)
-        return max(evaluations, key=evaluations.get)
+                score = self.kn.kn_log_evaluate_sentence(candidate_sent)
+                if score > best_score:
+                    best, best_score = candidate_sent, score
+        return best
+
+    def correct_sentence(self, sentence, beam_width=10):
+        """
+        Returns the most probable sentence, fixing any number of misspelled words
+
+        Runs a beam search over the candidates of every word. Partial sentences are scored as they grow
+        (candidate probability times the probabilities of the finished n-grams), partial sentences that
+        end with the same n-1 words are merged and only the best beam_width are kept for the next word.
+        """
+        sentence = preprocess_string(sentence)
+        n = self.kn.n_size
+        # The last n-1 words -> (log probability, chosen words as a linked list (word, previous))
+        beam = {('<s>',): (0.0, None)}
+        for word in sentence.split():
+            candidates = self.generate_candidates(word)
+            stats.observe('spellcheck.candidates', len(candidates))
+            if word not in candidates:
+                # Keep the original word as an option, words not in the dictionary get 1/V
+                candidates[word] = 1 / self.V_len
+            expanded = {}
+            for history, (score, chosen) in beam.items():
+                for candidate, probability in candidates.items():
+                    words = history + (candidate,)
+                    new_score = score + math.log(probability) + self.ngram_log_prob(words)
+                    key = words[-(n - 1):]
+                    if key not in expanded or new_score > expanded[key][0]:
+                        expanded[key] = (new_score, (candidate, chosen))
+            beam = dict(heapq.nlargest(beam_width, expanded.items(), key=lambda x: x[1][0]))
+
+        # Close the sentences with </s> and unwind the best one
+        _, chosen = max((score + self.ngram_log_prob(history + ('</s>',)), chosen)
+                        for history, (score, chosen) in beam.items())
+        words = []
+        while chosen is not None:
+            candidate, chosen = chosen
+            words.append(candidate)
+        return ' '.join(reversed(words))
+
+    def ngram_log_prob(self, words):
+        """ Returns the log probability of the n-gram if the words already form a whole n-gram """
+        if len(words) < self.kn.n_size:
+            return 0.0
+        return self.kn.log_prob(words)
 
     def get_best_candidate(self, word):
         """ Vrne najboljso kandidatko za podano nepravilno besedo """
@@ -266,6 +557,216 @@ class SpellCheck:
             cdid.write('\n'.join(corrections) + '\n')
 
 
+# The spell checker of a worker process (created once per process by init_worker)
+worker_checker = None
+# The ERR tags of the holbrook-tagged format (target words, misspelled words)
+err_tags = re.compile(r'<ERR targ=([^>]*)>(.*?)</ERR>')
+sentence_end = re.compile(r'(?<=[.!?])\s+')
+
+
+def read_sentences(filename, tagged=False, max_length=10000):
+    """
+    Streams the sentences of a plain text (or holbrook-tagged) file line by line. In plain text the
+    unfinished sentence at the end of a line is carried into the next line (hard-wrapped text), an empty
+    line ends it. Every line of the holbrook-tagged test set is a separate piece of text.
+    A carried text longer than max_length characters is returned as it is, so it does not grow without end.
+    """
+    carry = ''
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if tagged:
+                for sentence in sentence_end.split(err_tags.sub(r'\2', line)):
+                    if sentence:
+                        yield sentence
+                continue
+            if not line:
+                if carry:
+                    yield carry
+                carry = ''
+                continue
+            sentences = sentence_end.split((carry + ' ' + line).strip())
+            # The last sentence continues in the next line unless the line ends with the end of a sentence
+            carry = '' if line[-1] in '.!?' else sentences.pop()
+            for sentence in sentences:
+                if sentence:
+                    yield sentence
+            if len(carry) > max_length:
+                yield carry
+                carry = ''
+    if carry:
+        yield carry
+
+
+def build_caches(options):
+    """ Builds the persisted caches of the spell checker once, so the pool workers only read them """
+    checker = SpellCheck(**options)
+    checker.model
+    checker.index
+
+
+def init_worker(options):
+    """ Loads the spell checker once in every worker process """
+    global worker_checker
+    worker_checker = SpellCheck(**options)
+
+
+def check_in_worker(sentence):
+    """ Corrects one sentence with the spell checker of the worker process """
+    return worker_checker.correct_sentence(sentence)
+
+
+def check_file(input_file, output_file, processes=None, tagged=False, batch_size=10000, **options):
+    """
+    Spell checks a whole document and writes one corrected sentence per line (in the input order).
+    The sentences are read in batches of batch_size and checked by a pool of processes, each of
+    which loads the models once. The options are passed to the SpellCheck constructor.
+
+    :return: the number of sentences and sentences per second
+    """
+    start = timer()
+    count = 0
+    sentences = read_sentences(input_file, tagged)
+    with open(output_file, 'w') as out:
+        if processes == 1:
+            init_worker(options)
+            for sentence in sentences:
+                out.write(check_in_worker(sentence) + '\n')
+                count += 1
+        else:
+            build_caches(options)
+            with multiprocessing.Pool(processes, initializer=init_worker, initargs=(options,)) as pool:
+                while True:
+                    batch = list(islice(sentences, batch_size))
+                    if not batch:
+                        break
+                    for corrected in pool.imap(check_in_worker, batch, chunksize=64):
+                        out.write(corrected + '\n')
+                    count += len(batch)
+    elapsed = timer() - start
+    print('Checked %d sentences in %.2fs (%.1f sentences/s)' % (count, elapsed, count / elapsed))
+    return count, count / elapsed
+
+
+def parse_test_set(filename='holbrook-tagged.dat', cache_file='holbrook-tagged.json'):
+    """
+    Parses the tagged test set once into a list of [words, errors] for every line with a mistake.
+    The words are the preprocessed words of the line with the mistakes and every error is
+    [first word, last word + 1, target]. The result is cached together with the hash of the test set.
+    """
+    test_hash = file_hash(filename)
+    if cache_file and Path(cache_file).is_file():
+        with open(cache_file) as f:
+            saved = json.load(f)
+        if saved['hash'] == test_hash:
+            return saved['lines']
+
+    lines = []
+    with open(filename) as f:
+        for line in f:
+            words, errors, last = [], [], 0
+            for match in err_tags.finditer(line):
+                words += preprocess_string(line[last:match.start()]).split()
+                typo = preprocess_string(match.group(2)).split()
+                errors.append([len(words), len(words) + len(typo), ' '.join(preprocess_string(match.group(1)).split())])
+                words += typo
+                last = match.end()
+            words += preprocess_string(line[last:]).split()
+            if errors:
+                lines.append([words, errors])
+    if cache_file:
+        with replaced_file(cache_file) as f:
+            json.dump({'hash': test_hash, 'lines': lines}, f)
+    return lines
+
+
+def evaluate_in_worker(item):
+    """ Corrects one line of the test set and returns the results for every error in it """
+    words, errors = item
+    start = timer()
+    corrected = worker_checker.correct_sentence(' '.join(words)).split()
+    latency = timer() - start
+    fixed, best_only, candidate_counts = [], [], []
+    for first, last, target in errors:
+        fixed.append(' '.join(corrected[first:last]) == target)
+        best_only.append(' '.join(worker_checker.get_best_candidate(w) for w in words[first:last]) == target)
+        candidate_counts += [len(worker_checker.generate_candidates(w)) for w in words[first:last]]
+    return fixed, best_only, latency, candidate_counts
+
+
+def percentile(values, q):
+    """ Returns the q-th percentile (nearest rank) of the sorted values """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(math.ceil(q / 100 * len(values))) - 1)]
+
+
+def evaluate(test_set='holbrook-tagged.dat', processes=None, limit=None, cache_file='holbrook-tagged.json',
+             **options):
+    """
+    Evaluates the spell checker on every line of the tagged test set (lines with any number of errors)
+    in a pool of processes. Reports the accuracy of correct_sentence and of the best candidate only,
+    the latency percentiles per sentence and the statistics of the number of candidates.
+    The options are passed to the SpellCheck constructor.
+    """
+    lines = parse_test_set(test_set, cache_file)[:limit]
+    start = timer()
+    if processes == 1:
+        init_worker(options)
+        results = list(map(evaluate_in_worker, lines))
+    else:
+        build_caches(options)
+        with multiprocessing.Pool(processes, initializer=init_worker, initargs=(options,)) as pool:
+            results = pool.map(evaluate_in_worker, lines, chunksize=16)
+    elapsed = timer() - start
+
+    fixed = [f for result in results for f in result[0]]
+    best_only = [b for result in results for b in result[1]]
+    latencies = sorted(result[2] for result in results)
+    counts = sorted(c for result in results for c in result[3])
+    report = {
+        'sentences': len(lines),
+        'errors': len(fixed),
+        'accuracy': sum(fixed) / max(1, len(fixed)),
+        'best_candidate_accuracy': sum(best_only) / max(1, len(best_only)),
+        'latency_ms': {'p50': 1000 * percentile(latencies, 50), 'p90': 1000 * percentile(latencies, 90),
+                       'p99': 1000 * percentile(latencies, 99), 'max': 1000 * percentile(latencies, 100)},
+        'candidates': {'mean': sum(counts) / max(1, len(counts)), 'median': percentile(counts, 50),
+                       'max': percentile(counts, 100)},
+        'seconds': elapsed,
+    }
+    print('Evaluated %d sentences (%d errors) in %.2fs' % (report['sentences'], report['errors'], elapsed))
+    print('  accuracy %.4f, best candidate only %.4f' % (report['accuracy'], report['best_candidate_accuracy']))
+    print('  latency p50 %(p50).1fms p90 %(p90).1fms p99 %(p99).1fms max %(max).1fms' % report['latency_ms'])
+    print('  candidates mean %(mean).1f median %(median)d max %(max)d' % report['candidates'])
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Spell checks a document or evaluates the spell checker')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (all cores by default)')
+    parser.add_argument('--corpus', default='corpus/big.txt', help='the corpus of the word frequencies')
+    parser.add_argument('--model', default='big_model.lm', help='the Kneser-Ney language model')
+    parser.add_argument('--stats', metavar='FILE', help='write the timings and counters of the main process to FILE '
+                                                        '(JSON, or a cProfile profile if FILE ends with .prof)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    check_parser = commands.add_parser('check', help='corrects a whole document, one sentence per output line')
+    check_parser.add_argument('input')
+    check_parser.add_argument('output')
+    check_parser.add_argument('--tagged', action='store_true', help='the input is in the holbrook-tagged format')
+    evaluate_parser = commands.add_parser('evaluate', help='evaluates the accuracy and speed on a tagged test set')
+    evaluate_parser.add_argument('test_set', nargs='?', default='holbrook-tagged.dat')
+    evaluate_parser.add_argument('--limit', type=int, default=None, help='evaluate only the first lines')
+    args = parser.parse_args()
+    if args.stats:
+        stats.configure(args.stats)
+    if args.command == 'check':
+        check_file(args.input, args.output, args.processes, args.tagged,
+                   learn_corpus=args.corpus, model_file=args.model)
+    else:
+        evaluate(args.test_set, args.processes, args.limit, learn_corpus=args.corpus, model_file=args.model)
+    sys.exit(0)
+
 # Example usage:
 # p = SpellCheck()
 # print(p.check_sentence("siter"))
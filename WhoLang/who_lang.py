@@ -7,18 +7,33 @@
 # Deklaracije o clovekovih pravicah pridobljene s strani
 # https://www.ohchr.org/EN/UDHR/Pages/Introduction.aspx
 #
-# TODO: read xml files by paragraphs and guess the language for each
-#
 # @author David Rubin
 # @license MIT
 # FERI, Language Technologies, 2019
 import json
 import sys
-from collections import defaultdict, Counter, OrderedDict
+import numpy
+import xml.etree.ElementTree as ET
+from itertools import islice
+from multiprocessing import Pool
+from collections import defaultdict, deque, Counter, OrderedDict
 from math import sqrt
 from pathlib import Path
 from re import escape, compile
 from string import punctuation
+try:
+    from instrument import stats
+except ImportError:
+    # Skupna instrumentacija je v korenu repozitorija (../instrument.py)
+    sys.path.append(str(Path(__file__).resolve().parents[1]))
+    from instrument import stats
+
+
+# Atributa xml:id in xml:lang v dokumentih korpusa KAS
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+# Oznake xml:lang -> oznake jezikov v modelu
+XML_LANGS = {'en': 'eng', 'de': 'ger', 'sl': 'slv', 'cs': 'czk', 'sk': 'svk'}
 
 
 def cos_linkage(n_grams1, n_grams2):
@@ -30,6 +45,11 @@ def cos_linkage(n_grams1, n_grams2):
     return 1 - dot_product / (grams1_length * grams2_length)
 
 
+def profile_ranks(cat_profile):
+    """ Vrne slovar n-gram -> mesto v profilu kategorije (profil je urejen po pogostosti) """
+    return {ngram: rank for rank, ngram in enumerate(cat_profile)}
+
+
 def out_of_place_linkage(cat_profile, doc_profile, max_oop=301):
     """
     Poracuna out of place razdaljo med dvema seznamoma n gramov
@@ -40,15 +60,64 @@ def out_of_place_linkage(cat_profile, doc_profile, max_oop=301):
     :param max_oop: vrednost out of place za n grame, ki niso bili najdeni
     :return (int): skalar razdalje
     """
-    oop_sum = 0
-    for position, ngram in enumerate(doc_profile.keys()):
-        try:
-            oop = list(cat_profile.keys()).index(ngram)
-            oop_sum += oop
-        except ValueError:
-            # N-gram ni najden v mnozici
-            oop_sum += max_oop
-    return oop_sum
+    return out_of_place_ranked(profile_ranks(cat_profile), doc_profile, max_oop)
+
+
+def out_of_place_ranked(cat_ranks, doc_profile, max_oop=301):
+    """
+    Enako kot out_of_place_linkage, a z ze izracunanimi mesti n gramov v profilu kategorije,
+    zato je iskanje mesta O(1) (pri vec dokumentih mesta izracunamo le enkrat)
+
+    :param cat_ranks: slovar n gram -> mesto v profilu kategorije (glej profile_ranks)
+    :param doc_profile: seznam n gramov dokumenta
+    :param max_oop: vrednost out of place za n grame, ki niso bili najdeni
+    :return (int): skalar razdalje
+    """
+    # N-grami, ki jih ni v profilu kategorije, imajo vrednost max_oop
+    return sum(cat_ranks.get(ngram, max_oop) for ngram in doc_profile)
+
+
+# Jezikovni identifikator v procesu iz bazena (glej LanguageIdentifier.identify_batch)
+worker_identifier = None
+
+
+def init_worker(identifier):
+    """ Shrani identifikator, ki ga je poslal glavni proces, v proces iz bazena. """
+    global worker_identifier
+    worker_identifier = identifier
+
+
+def classify_in_worker(job):
+    """ Ugotovi jezike skupine besedil (ali datotek) v procesu iz bazena. """
+    texts, is_file, method = job
+    return worker_identifier.classify_batch([read_text(text) if is_file else text for text in texts], method)
+
+
+def read_text(filename):
+    """ Prebere celotno besedilo datoteke. """
+    with open(filename, 'rt', encoding='utf-8') as f:
+        return f.read()
+
+
+def iter_paragraphs(source):
+    """
+    Sproti (iterparse) bere odstavke XML dokumenta v obliki korpusa KAS (<page> z odstavki <p xml:lang=...>),
+    obdelane odstavke in strani pobrise, zato je poraba pomnilnika neodvisna od velikosti datoteke
+
+    :param source: ime datoteke ali odprta (binarna) datoteka
+    :return: generator trojic (xml:id, xml:lang, besedilo odstavka)
+    """
+    context = ET.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event != 'end':
+            continue
+        if elem.tag == 'p':
+            yield elem.get(XML_ID), elem.get(XML_LANG), ''.join(elem.itertext())
+            elem.clear()
+        elif elem.tag == 'page':
+            # Stran je obdelana, odstrani jo iz drevesa
+            root.clear()
 
 
 def walk(s, n=2):
@@ -57,9 +126,17 @@ def walk(s, n=2):
         yield s[i:i + n]
 
 
+def walk_orders(s, n=5, min_n=1):
+    """ Kreira n-grame vseh velikosti od min_n do n v enem prehodu cez s (za min_n == n enako kot walk). """
+    for i in range(len(s) - (min_n - 1)):
+        for k in range(min_n, min(n, len(s) - i) + 1):
+            yield s[i:i + k]
+
+
 class LanguageIdentifier:
-    def __init__(self, learn_folder='train/dohr', n=2):
+    def __init__(self, learn_folder='train/dohr', n=2, min_n=None):
         # train/dohr vsebuje Declaration of Human Rights v razlicnih prevodih
+        # Z min_n < n so profili mesani in vsebujejo terke vseh velikosti od min_n do n (Cavnar uporabi 1..5)
 
         # Slovar, v katerem so shranjeni mozni jeziki, pri cemer je kljuc oznaka jezika,
         # vrednost pa predstavlja ime jezika v izvirniku
@@ -70,30 +147,46 @@ class LanguageIdentifier:
             "czk": 'Cesko',
             "svk": "Slovasko",
         }
+        # Podatek o velikosti terk
+        self.n_size = n
+        self.min_n = n if min_n is None else min_n
         # Ime datoteke kamor shranimo jezikovni model
-        self.model_file = 'models/language_model_%d.json' % n
+        self.model_file = 'models/language_model_%s.json' % self.orders()
         # Slovar v katerm se nahaja predprocesirano besedilo deklaracije o neodvisnosti
         self.declaration = defaultdict(str)
         # Modeli za posamezne jezike
         self.lang_model = {}
-        # Podatek o velikosti terk
-        self.n_size = n
+        # Mesta n-gramov v profilih (jezik -> n-gram -> mesto) in skupna tabela n-gram -> mesta v vseh jezikih
+        # (None, ce n-grama v profilu jezika ni)
+        self.ranks = {}
+        self.rank_table = {}
+        # Profili vseh jezikov v eni matriki (vrstica = jezik) nad skupnim slovarjem n-gramov (glej build_matrix)
+        self.matrix_columns = {}
+        self.profile_matrix = None
+        self.profile_norms = None
         # Regularni izraz za delno predprocesiranje besedila (odstrani stevilke in locila)
         self.regex = compile(r'[0-9%s^(\s)]' % escape(punctuation))
         # Poskusaj prebrati model iz datoteke, drugace se nauci iz deklaracij
         if not self.load_model():
             print("Creating a new model")
             self.read_learn_set(learn_folder)
+            self.save_model()
 
     def preprocess_string(self, string):
         """ Zazene regularni izraz nad povedjo in spremeni vse whitespace v _
         prav tako oznaci zacetek in konec povedi z _ """
         return '_' + '_'.join(self.regex.sub(' ', (string.lower()).replace('\n', ' ')).split()) + '_'
 
+    def orders(self):
+        """ Vrne oznako velikosti terk v modelu, npr. '2' ali '1-5' za mesan profil """
+        if self.min_n == self.n_size:
+            return str(self.n_size)
+        return '%d-%d' % (self.min_n, self.n_size)
+
     def K_most_ngrams(self, text, k=300):
-        """ Vrne K najpogostejsih N-gramov iz podanega besedila. """
+        """ Vrne K najpogostejsih N-gramov (vseh velikosti od min_n do n) iz podanega besedila. """
         # return dict(sorted(Counter(walk(text, n=self.n_size)).items(), key=lambda s: s[1], reverse=True))[:k]
-        return OrderedDict(Counter(walk(text, n=self.n_size)).most_common(k))
+        return OrderedDict(Counter(walk_orders(text, self.n_size, self.min_n)).most_common(k))
 
     def read_learn_set(self, folder):
         """ Prebere deklaracije o clovekovih pravicah za izgradnjo modela. """
@@ -109,22 +202,90 @@ class LanguageIdentifier:
                 # namesto presledkov se dodajno podcrtaji (_)
                 self.declaration[code] = self.preprocess_string(declaration)
         self.lang_model = {key: self.K_most_ngrams(self.declaration[key], 300) for key in self.declaration.keys()}
+        self.build_ranks()
+        self.build_matrix()
+
+    def build_ranks(self):
+        """ Izracuna mesta n-gramov v profilih vseh jezikov, da je razdalja dokumenta en prehod O(k) """
+        self.ranks = {lang: profile_ranks(self.lang_model[lang]) for lang in self.possible_langs}
+        # Manjkajoca mesta zamenja vrednost max_oop sele pri izracunu razdalje (glej out_of_place_distances)
+        self.rank_table = defaultdict(lambda: [None] * len(self.possible_langs))
+        for i, lang in enumerate(self.possible_langs):
+            for ngram, rank in self.ranks[lang].items():
+                self.rank_table[ngram][i] = rank
+        self.rank_table = dict(self.rank_table)
+
+    def build_matrix(self):
+        """ Zapise profile vseh jezikov v eno matriko (vrstica = jezik) nad skupnim slovarjem n-gramov """
+        self.matrix_columns = {}
+        for lang in self.possible_langs:
+            for ngram in self.lang_model[lang]:
+                self.matrix_columns.setdefault(ngram, len(self.matrix_columns))
+        self.profile_matrix = numpy.zeros((len(self.possible_langs), len(self.matrix_columns)))
+        for i, lang in enumerate(self.possible_langs):
+            for ngram, count in self.lang_model[lang].items():
+                self.profile_matrix[i, self.matrix_columns[ngram]] = count
+        self.profile_norms = numpy.sqrt((self.profile_matrix ** 2).sum(axis=1))
+
+    def cosine_distances(self, doc_profiles):
+        """
+        Vrne kosinusne razdalje (enako kot cos_linkage) med dokumenti in vsemi jeziki z enim produktom redke
+        matrike dokumentov in matrike profilov (za vse jezike hkrati, brez zanke po jezikih)
+
+        :param doc_profiles: seznam profilov dokumentov (n gram -> stevilo pojavitev)
+        :return: matrika razdalj, vrstica je dokument, stolpec pa jezik
+        """
+        # Dokumenti so redki (najvec 300 n-gramov), zato hranimo le pare (vrstica, stolpec, stevilo)
+        rows, columns, counts = [], [], []
+        doc_norms = numpy.zeros(len(doc_profiles))
+        for row, profile in enumerate(doc_profiles):
+            for ngram, count in profile.items():
+                column = self.matrix_columns.get(ngram)
+                if column is not None:
+                    rows.append(row)
+                    columns.append(column)
+                    counts.append(count)
+            # N-grami, ki jih ni v nobenem jeziku, stejejo le v dolzino vektorja dokumenta
+            doc_norms[row] = sqrt(sum(x ** 2 for x in profile.values()))
+        rows = numpy.array(rows, dtype=numpy.int64)
+        columns = numpy.array(columns, dtype=numpy.int64)
+        counts = numpy.array(counts, dtype=numpy.float64)
+        # Skalarni produkti: stolpce profilov vseh jezikov pomnozimo s stetji in pristejemo vrsticam dokumentov
+        dots = numpy.zeros((len(doc_profiles), len(self.possible_langs)))
+        numpy.add.at(dots, rows, counts[:, None] * self.profile_matrix[:, columns].T)
+        lengths = numpy.outer(doc_norms, self.profile_norms)
+        lengths[lengths == 0] = numpy.inf
+        return 1 - dots / lengths
+
+    def out_of_place_distances(self, doc_profile, max_oop=301):
+        """
+        Vrne out of place razdalje dokumenta do vseh jezikov v enem prehodu cez njegove n-grame
+
+        :param doc_profile: seznam n gramov dokumenta
+        :param max_oop: vrednost out of place za n grame, ki jih ni v profilu jezika
+        """
+        missing = [None] * len(self.possible_langs)
+        sums = [0] * len(self.possible_langs)
+        for ngram in doc_profile:
+            for i, rank in enumerate(self.rank_table.get(ngram, missing)):
+                sums[i] += max_oop if rank is None else rank
+        return dict(zip(self.possible_langs, sums))
 
     def save_model(self):
         """ Shrani model jezikov v datoteko. """
         # Preko JSON shrani v datoteko
         with open(self.model_file, 'w+', encoding='utf-8') as f:
             # Write a header with model info
-            f.write(str(self.n_size) + "," + ','.join(self.possible_langs.keys()) + '\n')
+            f.write(self.orders() + "," + ','.join(self.possible_langs.keys()) + '\n')
             json.dump(self.lang_model, f, ensure_ascii=False)
 
     def load_model(self):
         """ Poskusa prebrati model iz diska. """
         if Path(self.model_file).is_file():
             with open(self.model_file) as f:
-                # Ima N_size,lang_codes
+                # Ima N_size (ali min_n-N_size),lang_codes
                 model_info = f.readline().rstrip().split(',')
-                if int(model_info[0]) != self.n_size:
+                if model_info[0] != self.orders():
                     # Model nima enake velikosti n, nauci se na novo
                     return False
                 for lang in self.possible_langs.keys():
@@ -132,9 +293,12 @@ class LanguageIdentifier:
                         # Nov jezik za model je zaznan
                         return False
                 self.lang_model = json.load(f)
+                self.build_ranks()
+                self.build_matrix()
                 return True
         return False
 
+    @stats.timed('who_lang.identify')
     def identify(self, text):
         """
         Poskusa ugotoviti v katerem jeziku je podano besedilo
@@ -145,15 +309,10 @@ class LanguageIdentifier:
         """
         # Preveri ali je podani text datoteka ali samo plaintext
         if Path(text).is_file():
-            with open(text, 'rt', encoding='utf-8') as f:
-                text_to_id = self.preprocess_string(f.read())
+            result = self.classify(read_text(text))
         else:
-            text_to_id = self.preprocess_string(text)
-
-        # Izgradi terke za vsak poznan jezik (iz deklaracij)
-        unknown_lang_grams = self.K_most_ngrams(text_to_id, 300)
+            result = self.classify(text)
 
-        self.save_model()
         # Izracunaj kosinusno razdaljo med tema dvema
         '''guesses = 3
         cos_similarity = {key + '+unknown': cos_linkage(known_lang_grams[key], unknown_lang_grams)
@@ -170,19 +329,125 @@ class LanguageIdentifier:
             except ZeroDivisionError:
                 print("Deljenje z 0! Teksta sta identicna?")'''
 
-        # Izracunaj out of place razdaljo za podane jezike in izberi najmanjso
-        distances = {lang_code: out_of_place_linkage(self.lang_model[lang_code], unknown_lang_grams)
-                     for lang_code in self.possible_langs}
-        guessed_lang = min(distances, key=distances.get)
+        distances = result['distances']
+        guessed_lang = result['language']
         print("\nInput: %s\nGuessed language: %s\n" % (text, self.possible_langs[guessed_lang]))
         print("Distances (out of place):")
         for dist in dict(sorted(distances.items(), key=lambda x: x[1])):
             print('\t%s %d' % (self.possible_langs[dist], distances[dist]))
 
+    def classify(self, text, method='out_of_place'):
+        """
+        Ugotovi jezik besedila brez izpisov in pisanja na disk
+
+        :param text: besedilo
+        :param method: nacin ocenjevanja, 'out_of_place' ali 'cosine'
+        :return: slovar z oznako in imenom najverjetnejsega jezika, razdaljami do vseh jezikov
+                 in zaupanjem (relativna razlika med najmanjso in drugo najmanjso razdaljo)
+        """
+        return self.classify_batch([text], method)[0]
+
+    @stats.timed('who_lang.classify_batch')
+    def classify_batch(self, texts, method='out_of_place'):
+        """ Ugotovi jezike seznama besedil (glej classify), kosinusne razdalje izracuna za vse naenkrat """
+        stats.count('who_lang.texts', len(texts))
+        # Izgradi terke besedil in izracunaj razdaljo za podane jezike, izberi najmanjso
+        profiles = [self.K_most_ngrams(self.preprocess_string(text), 300) for text in texts]
+        if method == 'out_of_place':
+            all_distances = [self.out_of_place_distances(profile) for profile in profiles]
+        elif method == 'cosine':
+            all_distances = [dict(zip(self.possible_langs, row)) for row in self.cosine_distances(profiles).tolist()]
+        else:
+            raise ValueError('Unknown scoring method: ' + method)
+
+        results = []
+        for distances in all_distances:
+            ranked = sorted(distances, key=distances.get)
+            second = distances[ranked[1]] if len(ranked) > 1 else 0
+            confidence = (second - distances[ranked[0]]) / second if second else 0.0
+            results.append({'language': ranked[0], 'name': self.possible_langs[ranked[0]],
+                            'distances': distances, 'confidence': confidence})
+        return results
+
+    def identify_batch(self, texts, files=False, processes=1, batch_size=10000, method='out_of_place'):
+        """
+        Ugotovi jezike vecjega stevila besedil, rezultate (glej classify) vraca po vrsti kot generator
+
+        :param texts: zaporedje besedil ali imen datotek
+        :param files: ali so texts imena datotek
+        :param processes: stevilo procesov v bazenu (None uporabi vsa jedra)
+        :param batch_size: koliko besedil naenkrat obdela (oziroma poslje v bazen)
+        :param method: nacin ocenjevanja, 'out_of_place' ali 'cosine'
+        """
+        texts = iter(texts)
+        pool = None if processes == 1 else Pool(processes, initializer=init_worker, initargs=(self,))
+        try:
+            while True:
+                batch = list(islice(texts, batch_size))
+                if not batch:
+                    break
+                if pool is None:
+                    yield from self.classify_batch([read_text(t) if files else t for t in batch], method)
+                else:
+                    # Procesom posiljamo skupine po 64 besedil
+                    jobs = [(batch[i:i + 64], files, method) for i in range(0, len(batch), 64)]
+                    for results in pool.imap(classify_in_worker, jobs):
+                        yield from results
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def identify_xml(self, source, processes=1, batch_size=1000, method='out_of_place'):
+        """
+        Ugotovi jezik vsakega odstavka XML dokumenta (glej iter_paragraphs), rezultate vraca sproti
+
+        :param source: ime datoteke ali odprta (binarna) datoteka
+        :param processes: stevilo procesov v bazenu (glej identify_batch)
+        :param batch_size: koliko odstavkov naenkrat obdela
+        :param method: nacin ocenjevanja, 'out_of_place' ali 'cosine'
+        :return: generator trojic (xml:id, rezultat (glej classify), oznaka jezika iz xml:lang ali None)
+        """
+        # Oznake odstavkov, katerih besedila so ze poslana v identify_batch, a rezultati se niso vrnjeni
+        pending = deque()
+
+        def texts():
+            for paragraph_id, lang, text in iter_paragraphs(source):
+                pending.append((paragraph_id, XML_LANGS.get(lang)))
+                yield text
+
+        for result in self.identify_batch(texts(), processes=processes, batch_size=batch_size, method=method):
+            paragraph_id, expected = pending.popleft()
+            yield paragraph_id, result, expected
+
+    def annotate_xml(self, source, out=sys.stdout, check=False, **kwargs):
+        """
+        Sproti izpisuje vrstice 'id jezik' za odstavke XML dokumenta (glej identify_xml)
+
+        :param source: ime datoteke ali odprta (binarna) datoteka
+        :param out: kam izpise rezultate
+        :param check: ali primerja rezultate z atributi xml:lang in izpise natancnost
+        :return: natancnost (delez odstavkov z enakim jezikom kot v xml:lang) ali None
+        """
+        checked = correct = 0
+        for paragraph_id, result, expected in self.identify_xml(source, **kwargs):
+            out.write('%s %s\n' % (paragraph_id, result['language']))
+            if check and expected is not None:
+                checked += 1
+                correct += result['language'] == expected
+        if not check:
+            return None
+        accuracy = correct / checked if checked else 0.0
+        print('Accuracy against xml:lang: %.2f%% (%d/%d)' % (accuracy * 100, correct, checked), file=sys.stderr)
+        return accuracy
+
     def help(self):
         """ Izpise pomoc za program. """
         print("A Python script for language identification of a given text using N-grams.\n\n" +
               "Currenlty supports English, German and Slovene texts, text files and xml files.\nMore can be added" +
               " by adding the DOHR files and inserting the filename into 'possible_langs'.")
-        print("\nUsage:\n\tlt = LanguageIdentifier(n=3)\n\tlt.identify(<text|file>)\n")
+        print("\nUsage:\n\tlt = LanguageIdentifier(n=3)\n\tlt.identify(<text|file>)\n" +
+              "\tlt = LanguageIdentifier(n=5, min_n=1)  # mixed 1..5-gram profiles\n" +
+              "\tresults = lt.identify_batch(<texts|files>, files=False, processes=1)\n" +
+              "\tresults = lt.identify_batch(<texts>, method='cosine')\n" +
+              "\tlt.annotate_xml(<xml file>, check=True)  # per-paragraph languages of a KAS document\n")
         print("The model is built using translations of human rights, view the header of the file for a link.")
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+#
+# Skupna instrumentacija modulov repozitorija: stoparice, stevci in histogrami.
+# Stoparice so konteksti (with stats.timer('ime')) ali dekoratorji (@stats.timed('ime')),
+# izmerjeni casi (v sekundah) se zbirajo v histogramih, zato vidimo tudi porazdelitev in ne le vsote.
+#
+# Instrumentacija je privzeto izklopljena in skoraj brez stroskov. Vklopimo jo s spremenljivko okolja
+# LANGTECH_STATS (ali s stats.configure), ki pove, kam ob izhodu zapisemo rezultate:
+#   LANGTECH_STATS=stats.json   statistika stoparic, stevcev in histogramov v JSON
+#   LANGTECH_STATS=stats.prof   profil cProfile (pregledamo ga s python -m pstats stats.prof)
+#
+# Statistika se zbira le v procesu, ki jo zapise (glavni proces). Procesi iz bazena ob izhodu
+# ne izvedejo atexit, zato za celotno sliko pozenemo obdelavo v enem procesu.
+#
+# @license MIT (check repository)
+# FERI, Language technoligies, 2019
+import os
+import json
+import math
+import atexit
+import cProfile
+import functools
+from collections import defaultdict
+from timeit import default_timer as timer
+
+# Spremenljivka okolja s potjo do datoteke za statistiko (glej zgoraj)
+STATS_ENV = 'LANGTECH_STATS'
+
+
+class Histogram:
+    """ Porazdelitev vrednosti v razredih, katerih meje so potence 2, s stevilom, vsoto, minimumom in maksimumom """
+    __slots__ = ('count', 'total', 'minimum', 'maximum', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.buckets = defaultdict(int)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        # Razred e vsebuje vrednosti iz [2^(e-1), 2^e), nepozitivne vrednosti so v razredu None
+        self.buckets[math.frexp(value)[1] if value > 0 else None] += 1
+
+    def percentile(self, q):
+        """ Vrne oceno q-tega percentila (zgornjo mejo razreda, v katerem je) """
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda x: -math.inf if x is None else x):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return 0.0 if bucket is None else min(math.ldexp(1, bucket), self.maximum)
+        return self.maximum
+
+    def to_dict(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count, 'sum': self.total, 'mean': self.total / self.count,
+                'min': self.minimum, 'max': self.maximum, 'p50': self.percentile(50),
+                'p90': self.percentile(90), 'p99': self.percentile(99),
+                'buckets': {'<=0' if bucket is None else '<%g' % math.ldexp(1, bucket): count
+                            for bucket, count in sorted(self.buckets.items(),
+                                                        key=lambda x: -math.inf if x[0] is None else x[0])}}
+
+
+class Timer:
+    """ Stoparica kot kontekst; cas (elapsed) izmeri vedno, v statistiko pa ga doda le, ce je vklopljena """
+    __slots__ = ('stats', 'name', 'start', 'elapsed')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = timer() - self.start
+        if self.stats.enabled:
+            self.stats.timers[self.name].add(self.elapsed)
+        return False
+
+
+class Stats:
+    """ Zbirka stoparic, stevcev in histogramov enega procesa """
+
+    def __init__(self):
+        self.enabled = False
+        self.timers = defaultdict(Histogram)
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.output = None
+        self.profiler = None
+
+    def configure(self, output):
+        """
+        Vklopi instrumentacijo in ob izhodu programa zapise rezultate v output
+
+        :param output: ime datoteke; s koncnico .prof zapise profil cProfile, sicer statistiko v JSON
+        """
+        self.enabled = True
+        if self.output is None:
+            atexit.register(self.dump)
+        self.output = output
+        if output.endswith('.prof') and self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def reset(self):
+        """ Pozabi vse zbrane vrednosti """
+        self.timers.clear()
+        self.counters.clear()
+        self.histograms.clear()
+
+    def timer(self, name):
+        """ Vrne stoparico za kontekst with, cas se doda v histogram stoparice name """
+        return Timer(self, name)
+
+    def timed(self, name):
+        """ Dekorator, ki meri cas klicev funkcije v stoparici name """
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = timer()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.timers[name].add(timer() - start)
+            return wrapper
+        return decorate
+
+    def timed_iter(self, name, iterable):
+        """ Vrne iterator, ki meri cas pridobivanja vsakega elementa (npr. branja strani iz generatorja) """
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(name, iter(iterable))
+
+    def _timed_iter(self, name, iterator):
+        while True:
+            start = timer()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.timers[name].add(timer() - start)
+            yield item
+
+    def count(self, name, n=1):
+        """ Pristeje n stevcu name """
+        if self.enabled:
+            self.counters[name] += n
+
+    def observe(self, name, value):
+        """ Doda vrednost v histogram name """
+        if self.enabled:
+            self.histograms[name].add(value)
+
+    def snapshot(self):
+        """ Vrne zbrane vrednosti kot slovar (za JSON) """
+        return {'pid': os.getpid(),
+                'timers': {name: x.to_dict() for name, x in sorted(self.timers.items())},
+                'counters': dict(sorted(self.counters.items())),
+                'histograms': {name: x.to_dict() for name, x in sorted(self.histograms.items())}}
+
+    def dump(self, output=None):
+        """ Zapise profil cProfile (koncnica .prof) ali statistiko v JSON v output (privzeto iz configure) """
+        output = output or self.output
+        if output is None:
+            return
+        if output.endswith('.prof'):
+            if self.profiler is not None:
+                self.profiler.disable()
+                self.profiler.dump_stats(output)
+            return
+        with open(output, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+
+# Skupna statistika procesa, ki jo uporabljajo vsi moduli
+stats = Stats()
+if os.environ.get(STATS_ENV):
+    stats.configure(os.environ[STATS_ENV])